@@ -2,6 +2,13 @@
 
 django-admin migrate --noinput
 
+# restart the update worker if it dies, else updates would be accepted but never pushed
+while true; do
+	django-admin dispatchupdates
+	echo "dispatchupdates exited with status $?, restarting in 5 seconds" >&2
+	sleep 5
+done &
+
 if [ "${DEBUG:-}" = True ]; then
 	exec django-admin runserver 0.0.0.0:8000
 else
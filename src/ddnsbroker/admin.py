@@ -1,25 +1,119 @@
+"""
+The admin is built for many hosts and records: the changelists are paginated with estimated counts, hosts are chosen
+with an autocomplete field and the update services are listed from a cache.
+
+Settings:
+    DDNSBROKER_ADMIN_INLINE_RECORDS: maximum number of records edited on the page of their host, hosts with more
+        records link to their records instead (default: 50)
+"""
+
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.http import HttpResponseRedirect
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+
+from ddnsbroker.models import Host, UpdateEvent, UpdateJob, UpdateJobItem, UpdateService, UpdateTask, Record
+
+# tables with fewer rows are counted exactly
+ESTIMATE_THRESHOLD = 10000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counts unfiltered changelists with the row estimate of PostgreSQL, counting all rows of a large table is slow.
+    """
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        connection = connections[self.object_list.db]
+        if connection.vendor == 'postgresql' and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] >= ESTIMATE_THRESHOLD:
+                return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+
+class ServiceChoicesMixin(object):
+    """
+    Lists the update services from the cache, instead of querying them for every record form.
+    """
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super(ServiceChoicesMixin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'service':
+            choices = [(service.pk, str(service)) for service in UpdateService.cached_all()]
+            if formfield.empty_label is not None:
+                choices.insert(0, ('', formfield.empty_label))
+            formfield.choices = choices
+        return formfield
+
+
+class PushStateChangeList(ChangeList):
+    def get_results(self, request):
+        super(PushStateChangeList, self).get_results(request)
+        # evaluates the page, the template and the list_editable formset use the same instances
+        self.model_admin.load_push_states(list(self.result_list))
+
+
+class PushStateMixin(object):
+    """
+    Shows the push state of the hosts or records on a changelist page, loaded with two queries per page: "failed" if a
+    record has an update error or a queued push failed before, "pending" if a push is queued, else "ok".
+    """
+
+    # paths from UpdateTask and from Record to the model of the admin
+    push_task_path = 'record'
+    push_record_path = 'pk'
+
+    def get_changelist(self, request, **kwargs):
+        return PushStateChangeList
 
-from ddnsbroker.models import Host, UpdateService, Record
+    def load_push_states(self, objects) -> None:
+        pks = [obj.pk for obj in objects]
+        failed = set(Record.objects.filter(**{self.push_record_path + '__in': pks}).exclude(update_error="")
+                     .values_list(self.push_record_path, flat=True))
+        pending = set()
+        for pk, attempts in UpdateTask.objects.filter(**{self.push_task_path + '__in': pks}).values_list(
+                self.push_task_path, 'attempts'):
+            (failed if attempts else pending).add(pk)
+        for obj in objects:
+            obj.push_state = "failed" if obj.pk in failed else "pending" if obj.pk in pending else "ok"
 
+    def push(self, obj):
+        return getattr(obj, 'push_state', "-")
 
-class RecordInline(admin.TabularInline):
+
+class RecordInline(ServiceChoicesMixin, admin.TabularInline):
     model = Record
 
 
-class HostAdmin(admin.ModelAdmin):
+class HostAdmin(PushStateMixin, admin.ModelAdmin):
     fieldsets = (
         (None, {
-            'fields': ('fqdn', 'secret', ('ipv4_enabled', 'ipv6_enabled'))
+            'fields': ('fqdn', 'secret', ('ipv4_enabled', 'ipv6_enabled'), 'records')
         }),
         ('Manual IPs', {
             'classes': ('collapse',),
             'fields': ('ipv4', 'ipv6')
+        }),
+        ('Updates', {
+            'classes': ('collapse',),
+            'fields': ('debounce', 'history')
         })
     )
 
-    list_display = ('fqdn', 'ipv4_enabled', 'ipv6_enabled', 'ipv4', 'ipv6')
+    readonly_fields = ('records', 'history')
+
+    list_display = ('fqdn', 'ipv4_enabled', 'ipv6_enabled', 'ipv4', 'ipv6', 'push')
 
     list_editable = ('ipv4_enabled', 'ipv6_enabled', 'ipv4', 'ipv6')
 
@@ -27,20 +121,60 @@ class HostAdmin(admin.ModelAdmin):
 
     search_fields = ('fqdn',)
 
+    paginator = EstimatedCountPaginator
+
+    show_full_result_count = False
+
     inlines = [RecordInline]
 
+    push_task_path = 'record__host'
+
+    push_record_path = 'host'
+
+    def changelist_view(self, request, extra_context=None):
+        # the hosts saved by list_editable are propagated to their records together
+        request.staged_hosts = []
+        response = super(HostAdmin, self).changelist_view(request, extra_context)
+        if request.staged_hosts:
+            Record.propagate(request.staged_hosts)
+        return response
+
+    def save_model(self, request, obj, form, change):
+        staged = getattr(request, 'staged_hosts', None)
+        obj.save(propagate=staged is None)
+        if staged is not None:
+            staged.append(obj)
+
+    def get_inlines(self, request, obj):
+        if obj is not None and \
+                obj.record_set.count() > getattr(settings, 'DDNSBROKER_ADMIN_INLINE_RECORDS', 50):
+            return []
+        return super(HostAdmin, self).get_inlines(request, obj)
+
+    def records(self, obj):
+        if obj.pk is None:
+            return "-"
+        url = "{}?host__id__exact={}".format(reverse('admin:ddnsbroker_record_changelist'), obj.pk)
+        return format_html('<a href="{}">Records of this host</a>', url)
+
+    def history(self, obj):
+        if obj.pk is None:
+            return "-"
+        url = "{}?host__id__exact={}".format(reverse('admin:ddnsbroker_updateevent_changelist'), obj.pk)
+        return format_html('<a href="{}">Address changes and pushes</a>', url)
+
     def add_view(self, request, form_url='', extra_context=None):
         extra_context = extra_context or {}
-        extra_context['updateServices'] = UpdateService.objects.all()
+        extra_context['updateServices'] = UpdateService.cached_all()
         return super(HostAdmin, self).add_view(request, form_url, extra_context)
 
     def change_view(self, request, object_id, form_url='', extra_context=None):
         extra_context = extra_context or {}
-        extra_context['updateServices'] = UpdateService.objects.all()
+        extra_context['updateServices'] = UpdateService.cached_all()
         return super(HostAdmin, self).change_view(request, object_id, form_url, extra_context)
 
 
-class RecordAdmin(admin.ModelAdmin):
+class RecordAdmin(PushStateMixin, ServiceChoicesMixin, admin.ModelAdmin):
     fieldsets = (
         (None, {
             'fields': ('host', 'fqdn', ('ipv4_enabled', 'ipv6_enabled'))
@@ -49,20 +183,30 @@ class RecordAdmin(admin.ModelAdmin):
             'fields': ('ipv4_netmask', 'ipv4_host_id', 'ipv6_netmask', 'ipv6_host_id')
         }),
         ('Update service', {
-            'fields': ('service', 'username', 'password')
+            'fields': ('service', 'username', 'password', 'update_error')
         })
     )
 
-    list_display = ('fqdn', 'host', 'ipv4_enabled', 'ipv6_enabled', 'effective_ipv4', 'effective_ipv6', 'service')
+    readonly_fields = ('update_error',)
+
+    list_display = ('fqdn', 'host', 'ipv4_enabled', 'ipv6_enabled', 'effective_ipv4', 'effective_ipv6', 'service',
+                    'push')
 
     list_editable = ('ipv4_enabled', 'ipv6_enabled')
 
-    list_filter = (
-        ('host', admin.RelatedOnlyFieldListFilter),
-        'ipv4_enabled',
-        'ipv6_enabled',
-        ('service', admin.RelatedOnlyFieldListFilter)
-    )
+    # filter by host with ?host__id__exact=, listing all hosts does not scale
+    list_filter = ('ipv4_enabled', 'ipv6_enabled', 'service')
+
+    list_select_related = ('host', 'service')
+
+    # the unique index of (host, fqdn), ordering by the FQDN of the host sorts all records
+    ordering = ('host_id', 'fqdn')
+
+    autocomplete_fields = ('host',)
+
+    paginator = EstimatedCountPaginator
+
+    show_full_result_count = False
 
     save_as = True
 
@@ -72,24 +216,92 @@ class RecordAdmin(admin.ModelAdmin):
 
     actions = ['update_records']
 
-    def update_records(self, request, queryset):  # TODO: maybe with intermediate page because it could take long
-        for record in queryset:
-            pass
-        self.message_user(request, "This function is not yet implemented", level=messages.WARNING)
+    def update_records(self, request, queryset):
+        job = UpdateJob.start(queryset)
+        self.message_user(request, "{} queued, the pushes are done by the dispatchupdates worker".format(job),
+                          level=messages.SUCCESS)
+        return HttpResponseRedirect(reverse('admin:ddnsbroker_updatejob_change', args=(job.pk,)))
 
     update_records.short_description = "Force update selected records"
 
     def add_view(self, request, form_url='', extra_context=None):
         extra_context = extra_context or {}
-        extra_context['updateServices'] = UpdateService.objects.all()
+        extra_context['updateServices'] = UpdateService.cached_all()
         return super(RecordAdmin, self).add_view(request, form_url, extra_context)
 
     def change_view(self, request, object_id, form_url='', extra_context=None):
         extra_context = extra_context or {}
-        extra_context['updateServices'] = UpdateService.objects.all()
+        extra_context['updateServices'] = UpdateService.cached_all()
         return super(RecordAdmin, self).change_view(request, object_id, form_url, extra_context)
 
 
+class UpdateJobItemInline(admin.TabularInline):
+    model = UpdateJobItem
+
+    fields = readonly_fields = ('record', 'family', 'ip', 'result', 'finished')
+
+    can_delete = False
+
+    extra = 0
+
+    def get_queryset(self, request):
+        return super(UpdateJobItemInline, self).get_queryset(request).select_related('record')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class UpdateJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'created', 'progress')
+
+    fields = readonly_fields = ('created', 'progress')
+
+    inlines = [UpdateJobItemInline]
+
+    def progress(self, obj):
+        return "{finished} of {total} finished, {succeeded} succeeded, {failed} failed".format(**obj.progress())
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        extra_context = extra_context or {}
+        job = self.get_object(request, object_id)
+        if job is not None:
+            progress = job.progress()
+            # reload the page until all results are in
+            extra_context['refresh'] = progress['finished'] < progress['total']
+        return super(UpdateJobAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+
+class UpdateEventAdmin(admin.ModelAdmin):
+    list_display = ('time', 'host', 'record', 'kind', 'family', 'ip', 'result')
+
+    list_filter = ('kind', 'result')
+
+    # counting tens of millions of events is slow
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # not select_related (False would still join the foreign keys of list_display), its inner join would hide the
+    # events of deleted hosts, they are prefetched instead
+    list_select_related = ()
+
+    ordering = ('-time',)
+
+    def get_queryset(self, request):
+        return super(UpdateEventAdmin, self).get_queryset(request).prefetch_related('host', 'record')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 class UpdateServiceAdmin(admin.ModelAdmin):
     list_display = ('name', 'url')
 
@@ -99,3 +311,5 @@ class UpdateServiceAdmin(admin.ModelAdmin):
 admin.site.register(Host, HostAdmin)
 admin.site.register(Record, RecordAdmin)
 admin.site.register(UpdateService, UpdateServiceAdmin)
+admin.site.register(UpdateJob, UpdateJobAdmin)
+admin.site.register(UpdateEvent, UpdateEventAdmin)
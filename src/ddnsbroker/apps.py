@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DDnsBrokerConfig(AppConfig):
     name = 'ddnsbroker'
     verbose_name = "DDnsBroker"
+
+    def ready(self):
+        # register the metrics collectors of the modules that are not imported by the views
+        from ddnsbroker import dispatch, dyndns2  # noqa: F401
@@ -0,0 +1,64 @@
+"""
+Query plans of the hot lookups, checked by the auditqueries management command.
+
+Every query must be answered by searching an index or by scanning a partial index: a plan that scans a whole table,
+or a whole index of it, makes the query O(rows) instead of O(matches), which only shows once there are many hosts
+and records.
+"""
+
+import re
+from datetime import timedelta
+from typing import Callable, Dict, List, Set, Tuple
+
+from django.apps import apps
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from ddnsbroker.models import Host, Record, UpdateEvent, UpdateJobItem, UpdateTask
+
+HOT_QUERIES: Dict[str, Callable[[], QuerySet]] = {
+    'host by fqdn': lambda: Host.objects.filter(fqdn='host.example.com'),
+    'records of a host': lambda: Record.objects.filter(host_id=1),
+    'records of a service': lambda: Record.objects.filter(service_id=1),
+    'hosts of a service': lambda: Host.objects.filter(record__service_id=1).distinct(),
+    'due tasks': lambda: UpdateTask.objects.filter(not_before__lte=timezone.now()).order_by('not_before'),
+    'tasks of records': lambda: UpdateTask.objects.filter(record__in=[1, 2, 3]),
+    'records needing an ipv4 push': lambda: Record.needing_push(UpdateTask.IPV4),
+    'records needing an ipv6 push': lambda: Record.needing_push(UpdateTask.IPV6),
+    'history of a host': lambda: UpdateEvent.objects.filter(host_id=1).order_by('-time'),
+    'expired history': lambda: UpdateEvent.objects.filter(time__lt=timezone.now() - timedelta(days=90)),
+    'items of a job': lambda: UpdateJobItem.objects.filter(job_id=1),
+}
+
+# SQLite plan lines that read a whole table or index, e.g. "SCAN ddnsbroker_record USING COVERING INDEX ..."
+_SCAN = re.compile(r'\bSCAN (TABLE )?(?P<table>\w+)( USING (COVERING )?INDEX (?P<index>\w+))?')
+
+
+def partial_indexes() -> Set[str]:
+    """
+    :return: names of the indexes with a condition, scanning them only reads the matching rows
+    """
+    return {index.name for model in apps.get_app_config('ddnsbroker').get_models()
+            for index in model._meta.indexes if index.condition is not None}
+
+
+def full_scans(plan: str) -> List[str]:
+    """
+    :return: the tables the SQLite query plan reads completely
+    """
+    partial = partial_indexes()
+    return [match.group('table') for match in map(_SCAN.search, plan.splitlines())
+            if match and match.group('index') not in partial]
+
+
+def audit() -> List[Tuple[str, str, List[str]]]:
+    """
+    Explain all hot queries.
+    :return: (name, plan, fully scanned tables) of every query, the tables are only detected on SQLite
+    """
+    results = []
+    for name, queryset in HOT_QUERIES.items():
+        plan = queryset().explain()
+        results.append((name, plan, full_scans(plan) if connection.vendor == 'sqlite' else []))
+    return results
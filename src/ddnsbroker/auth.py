@@ -0,0 +1,217 @@
+"""
+Verification of host secrets with a cache of recently verified credentials.
+
+Checking a Django password hash is deliberately slow, but routers send the same credentials every few minutes.
+A successful check is remembered per FQDN as HMAC of the secret (the plain secret is never stored), together with
+the hash it was checked against. A cache hit is only accepted if the host still has that hash, so a changed secret
+is never served from the cache, not even from the cache of another process. This holds because the host is read from
+the database or from a host cache shared by all processes, see ddnsbroker.hostcache.
+
+Host secrets are random tokens, so they can optionally be hashed with a keyed HMAC-SHA256 instead of a slow password
+hasher. A hash of the other scheme is replaced by a hash of the configured scheme on the next successful check.
+
+Clients that keep sending bad credentials are answered without a database lookup or a hash check: failures are
+counted per pair of username and presented secret, so a misconfigured router cannot lock out the correct secret,
+and per client address. The client address is the peer address of the connection, or the address a trusted reverse
+proxy reports in X-Forwarded-For (see ddnsbroker.views.client_address), so clients cannot get others blocked.
+
+Settings:
+    DDNSBROKER_AUTH_CACHE_SIZE: maximum number of cached credentials, 0 disables the cache (default: 10000)
+    DDNSBROKER_AUTH_CACHE_TTL: seconds a verified credential is cached (default: 300)
+    DDNSBROKER_SECRET_HASHER: 'hmac_sha256' or 'default' for the default Django password hasher (default: 'default')
+    DDNSBROKER_SECRET_PEPPER: key of the HMAC, hosts have to get new secrets if it changes (default: SECRET_KEY)
+    DDNSBROKER_BADAUTH_WINDOW: seconds in which failed checks are counted (default: 300)
+    DDNSBROKER_BADAUTH_MAX_CREDENTIAL_FAILURES: failures of the same credentials after which they are rejected,
+        0 disables it (default: 5)
+    DDNSBROKER_BADAUTH_MAX_ADDRESS_FAILURES: failures from one client address after which it is rejected,
+        0 disables it (default: 0, behind a reverse proxy only enable it with DDNSBROKER_TRUSTED_PROXIES, else all
+        clients share the address of the proxy)
+    DDNSBROKER_BADAUTH_TRACKER_SIZE: maximum number of tracked credentials and of tracked addresses (default: 10000)
+"""
+
+import hashlib
+import hmac
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.hashers import BasePasswordHasher, get_hasher, identify_hasher, mask_hash, make_password
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.translation import gettext_noop as _
+
+from ddnsbroker import metrics
+from ddnsbroker.tools.cache import FailureTracker, LRUCache
+
+auth_cache = LRUCache(
+    maxsize=getattr(settings, 'DDNSBROKER_AUTH_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'DDNSBROKER_AUTH_CACHE_TTL', 300))
+
+credential_failures = FailureTracker(
+    maxsize=getattr(settings, 'DDNSBROKER_BADAUTH_TRACKER_SIZE', 10000),
+    window=getattr(settings, 'DDNSBROKER_BADAUTH_WINDOW', 300),
+    threshold=getattr(settings, 'DDNSBROKER_BADAUTH_MAX_CREDENTIAL_FAILURES', 5))
+
+address_failures = FailureTracker(
+    maxsize=getattr(settings, 'DDNSBROKER_BADAUTH_TRACKER_SIZE', 10000),
+    window=getattr(settings, 'DDNSBROKER_BADAUTH_WINDOW', 300),
+    threshold=getattr(settings, 'DDNSBROKER_BADAUTH_MAX_ADDRESS_FAILURES', 0))
+
+
+class HostSecretHasher(BasePasswordHasher):
+    """
+    HMAC-SHA256 of the salted secret, keyed with a server side pepper.
+
+    Only suitable for long random secrets: a single HMAC is cheap, so the hash protects a leaked database only
+    through the entropy of the secret and the pepper, which is not stored in the database.
+    """
+    algorithm = 'hmac_sha256'
+
+    def __init__(self, pepper: Optional[str] = None):
+        if pepper is None:
+            pepper = getattr(settings, 'DDNSBROKER_SECRET_PEPPER', settings.SECRET_KEY)
+        self.pepper = pepper.encode('utf-8')
+
+    def encode(self, password, salt):
+        assert password is not None
+        assert salt and '$' not in salt
+        digest = hmac.new(self.pepper, "{}${}".format(salt, password).encode('utf-8'), hashlib.sha256).hexdigest()
+        return "{}${}${}".format(self.algorithm, salt, digest)
+
+    def verify(self, password, encoded):
+        algorithm, salt, digest = encoded.split('$', 2)
+        assert algorithm == self.algorithm
+        return constant_time_compare(encoded, self.encode(password, salt))
+
+    def safe_summary(self, encoded):
+        algorithm, salt, digest = encoded.split('$', 2)
+        return OrderedDict([
+            (_('algorithm'), algorithm),
+            (_('salt'), mask_hash(salt)),
+            (_('hash'), mask_hash(digest)),
+        ])
+
+    def harden_runtime(self, password, encoded):
+        pass
+
+
+def get_secret_hasher() -> BasePasswordHasher:
+    """
+    :return: the hasher for new host secrets
+    """
+    if getattr(settings, 'DDNSBROKER_SECRET_HASHER', 'default') == HostSecretHasher.algorithm:
+        return HostSecretHasher()
+    return get_hasher('default')
+
+
+def make_secret(secret: str) -> str:
+    """
+    Hash a host secret with the configured hasher.
+    """
+    return make_password(secret, hasher=get_secret_hasher())
+
+
+def verify_secret(secret: str, encoded: str) -> Tuple[bool, bool]:
+    """
+    Check a secret against its hash.
+    :return: whether the secret is correct and whether the hash should be replaced by one of the configured hasher
+    """
+    if encoded.startswith(HostSecretHasher.algorithm + '$'):
+        hasher = HostSecretHasher()
+    else:
+        try:
+            hasher = identify_hasher(encoded)
+        except ValueError:
+            return False, False
+
+    valid = hasher.verify(secret, encoded)
+    must_update = hasher.algorithm != get_secret_hasher().algorithm or hasher.must_update(encoded)
+    if not valid and must_update:
+        hasher.harden_runtime(secret, encoded)
+    return valid, must_update
+
+
+def _digest(fqdn: str, secret: str) -> str:
+    return salted_hmac('ddnsbroker.auth', "{}:{}".format(fqdn, secret)).hexdigest()
+
+
+def check_secret(fqdn: str, secret: str, encoded: str, setter: Optional[Callable[[str], None]] = None) -> bool:
+    """
+    Check a secret against the hash of a host.
+    :param fqdn: host FQDN
+    :param secret: presented secret
+    :param encoded: hashed secret of the host
+    :param setter: called with a new hash of the secret if the hash has to be upgraded
+    """
+    digest = _digest(fqdn, secret)
+
+    cached = auth_cache.get(fqdn)
+    if cached is not None and constant_time_compare(cached[0], digest) and cached[1] == encoded:
+        metrics.AUTH_CACHE_LOOKUPS.inc('hit')
+        return True
+    metrics.AUTH_CACHE_LOOKUPS.inc('miss')
+
+    with metrics.PHASE_SECONDS.time('hash'):
+        valid, must_update = verify_secret(secret, encoded)
+    if not valid:
+        return False
+
+    if must_update:
+        encoded = make_secret(secret)
+        if setter is not None:
+            setter(encoded)
+
+    auth_cache.set(fqdn, (digest, encoded))
+    return True
+
+
+def is_blocked(username: str, secret: str, address: Optional[str] = None) -> bool:
+    """
+    Whether a client is answered with badauth without checking its credentials.
+    :param username: presented username
+    :param secret: presented secret
+    :param address: client address, None to check the credentials only
+    """
+    if address is not None and is_address_blocked(address):
+        return True
+    if credential_failures.is_blocked((username, _digest(username, secret))):
+        metrics.BADAUTH_REJECTIONS.inc('credentials')
+        return True
+    return False
+
+
+def is_address_blocked(address: str) -> bool:
+    """
+    Whether all requests of a client address are answered with badauth without checking their credentials.
+    """
+    if address_failures.is_blocked(address):
+        metrics.BADAUTH_REJECTIONS.inc('address')
+        return True
+    return False
+
+
+def record_failure(username: str, secret: str, address: Optional[str] = None) -> None:
+    """
+    Count failed credentials, the username may not exist.
+    :param address: client address, None to count it separately with record_address_failure, e.g. once per request
+    """
+    metrics.BADAUTH_FAILURES.inc()
+    credential_failures.fail((username, _digest(username, secret)))
+    if address is not None:
+        record_address_failure(address)
+
+
+def record_address_failure(address: str) -> None:
+    address_failures.fail(address)
+
+
+def invalidate(fqdn: str) -> None:
+    auth_cache.delete(fqdn)
+    # a new secret may be what a rejected client has sent
+    credential_failures.forget(lambda key: key[0] == fqdn)
+
+
+@metrics.register_collector
+def _collect():
+    return metrics.gauge(
+        'ddnsbroker_badauth_tracked', "Credentials and client addresses with recent failed checks.",
+        [({'key': 'credentials'}, len(credential_failures)), ({'key': 'address'}, len(address_failures))])
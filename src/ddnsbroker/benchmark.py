@@ -0,0 +1,381 @@
+"""
+Benchmark scenarios of the update path, run by the benchmark management command on a fresh test database.
+
+The views are called directly with requests from Django's RequestFactory, the pushes go to a local stub dyndns2
+server. Every scenario reports throughput, latency percentiles and, for the sync views, queries per request. The admin
+scenario renders the admin pages of the hosts and records the same way, as a superuser.
+
+No WSGI or ASGI server is involved: comparing the sync and the async views (--asgi) compares the views called
+in-process, without the request parsing, the worker model and the event loop of a real server.
+"""
+
+import asyncio
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipaddress import IPv6Address, IPv6Network
+from typing import Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from ddnsbroker import auth, lastseen
+from ddnsbroker.dispatch import dispatch_pending
+from ddnsbroker.models import Host, Record, UpdateService, UpdateTask
+from ddnsbroker.tools.ip import effective_ipv6_many
+from ddnsbroker.views import AsyncNicUpdateView, NicUpdateView
+
+SECRET = 'benchmark'
+
+# renderings of every admin page in the admin scenario
+ADMIN_VIEWS = 10
+
+
+class StubServer(object):
+    """
+    A local dyndns2 server that answers "good" for every hostname, optionally after a delay.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.requests = 0
+        stub = self
+
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if delay:
+                    time.sleep(delay)
+                query = parse_qs(urlparse(self.path).query)
+                stub.requests += 1
+                body = "\n".join("good {}".format(query['myip'][0]) for _ in query['hostname'][0].split(","))
+                body = body.encode('ascii')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.url = 'http://127.0.0.1:{}/nic/update'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def summarize(durations: List[float], wall: float, queries: Optional[List[int]] = None, errors: int = 0) -> Dict:
+    summary = {
+        'requests': len(durations),
+        'errors': errors,
+        'seconds': round(wall, 6),
+        'per_second': round(len(durations) / wall, 1) if wall else None,
+        'mean_ms': round(sum(durations) / len(durations) * 1000, 3) if durations else None,
+        'p50_ms': round(_percentile(durations, 50) * 1000, 3),
+        'p95_ms': round(_percentile(durations, 95) * 1000, 3),
+        'p99_ms': round(_percentile(durations, 99) * 1000, 3),
+        'max_ms': round(max(durations) * 1000, 3) if durations else None,
+    }
+    if queries is not None:
+        summary['queries_per_request'] = round(sum(queries) / len(queries), 2) if queries else None
+        summary['max_queries'] = max(queries) if queries else None
+    return summary
+
+
+class Benchmark(object):
+    def __init__(self, hosts: int = 100, records: int = 10, requests: int = 1000, concurrency: int = 16,
+                 asgi: bool = False, delay: float = 0.0):
+        self.hosts = hosts
+        self.records = records
+        self.requests = requests
+        self.concurrency = concurrency
+        self.asgi = asgi
+        self.factory = RequestFactory()
+        self.stub = StubServer(delay=delay)
+        self.view = AsyncNicUpdateView.as_view() if asgi else NicUpdateView.as_view()
+        self.fqdns: List[str] = []
+        self.counter = 0
+
+    def close(self) -> None:
+        self.stub.close()
+
+    def setup(self) -> None:
+        # the concurrency of the service does not limit the workers of the dispatch scenario
+        service = UpdateService.objects.create(name='stub', url=self.stub.url, max_hostnames=20,
+                                               concurrency=self.concurrency)
+
+        # hash once, hashing a secret per host would dominate the setup
+        secret = auth.make_secret(SECRET)
+        self.fqdns = ["host{}.bench.example.com".format(i) for i in range(self.hosts)]
+        Host.objects.bulk_create([Host(fqdn=fqdn, secret=secret) for fqdn in self.fqdns], batch_size=500)
+
+        records = []
+        for host in Host.objects.all():
+            for i in range(self.records):
+                records.append(Record(
+                    host=host, fqdn="r{}.{}".format(i, host.fqdn), service=service, password='password',
+                    ipv6_netmask=64, ipv6_host_id="::{:x}".format(i + 1)))
+        Record.objects.bulk_create(records, batch_size=500)
+
+    def __request(self, fqdn: str, ips: List[str], secret: str = SECRET):
+        credentials = base64.b64encode("{}:{}".format(fqdn, secret).encode('utf-8')).decode('ascii')
+        return self.factory.get('/nic/update', {'myip': ips}, HTTP_AUTHORIZATION="Basic " + credentials)
+
+    def __ips(self, host_index: int, generation: int) -> List[str]:
+        return ["10.{}.{}.{}".format(generation % 256, host_index // 256 % 256, host_index % 256),
+                "2001:db8:{:x}:{:x}::1".format(generation % 65536, host_index % 65536)]
+
+    def __run(self, requests: List, count_queries: bool = True) -> Dict:
+        """
+        Send the requests one after another.
+        """
+        durations, queries, errors = [], [], [0]
+        count_queries = count_queries and not self.asgi
+
+        def send(request):
+            start = time.perf_counter()
+            try:
+                if count_queries:
+                    with CaptureQueriesContext(connection) as context:
+                        response = self.view(request)
+                    queries.append(len(context))
+                else:
+                    response = self.view(request)
+                errors[0] += response.status_code >= 500
+            except Exception:
+                errors[0] += 1
+            durations.append(time.perf_counter() - start)
+
+        async def run_async():
+            for request in requests:
+                start = time.perf_counter()
+                try:
+                    response = await self.view(request)
+                    errors[0] += response.status_code >= 500
+                except Exception:
+                    errors[0] += 1
+                durations.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if self.asgi:
+            asyncio.run(run_async())
+        else:
+            for request in requests:
+                send(request)
+        wall = time.perf_counter() - start
+
+        return summarize(durations, wall, queries if count_queries else None, errors[0])
+
+    def __run_concurrent(self, requests: List) -> Dict:
+        """
+        Send the requests with `concurrency` requests in flight.
+        """
+        durations, errors = [], [0]
+
+        def send(request):
+            start = time.perf_counter()
+            try:
+                response = self.view(request)
+                errors[0] += response.status_code >= 500
+            except Exception:
+                errors[0] += 1
+            durations.append(time.perf_counter() - start)
+
+        async def send_async(request, semaphore):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await self.view(request)
+                    errors[0] += response.status_code >= 500
+                except Exception:
+                    errors[0] += 1
+                durations.append(time.perf_counter() - start)
+
+        async def run_async():
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*(send_async(request, semaphore) for request in requests))
+
+        start = time.perf_counter()
+        if self.asgi:
+            asyncio.run(run_async())
+        else:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(send, requests))
+        wall = time.perf_counter() - start
+
+        return summarize(durations, wall, errors=errors[0])
+
+    def __next_generation(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    def __requests(self, generation: Optional[Callable[[], int]] = None, secret: str = SECRET) -> List:
+        requests = []
+        for i in range(self.requests):
+            host_index = i % self.hosts
+            ips = self.__ips(host_index, generation() if generation else 0)
+            requests.append(self.__request(self.fqdns[host_index], ips, secret=secret))
+        return requests
+
+    def scenario_nochg(self) -> Dict:
+        """
+        Steady state: every host reports the address it already has.
+        """
+        self.__run([self.__request(fqdn, self.__ips(i, 0)) for i, fqdn in enumerate(self.fqdns)], False)
+        UpdateTask.objects.all().delete()
+        result = self.__run(self.__requests())
+        lastseen.last_seen.flush()
+        return result
+
+    def scenario_ipchange(self) -> Dict:
+        """
+        Every request changes the address of a host with `records` records.
+        """
+        result = self.__run(self.__requests(generation=self.__next_generation))
+        result['records_per_host'] = self.records
+        return result
+
+    def scenario_badauth(self) -> Dict:
+        """
+        A flood of requests with a wrong secret, mostly answered by the failure trackers.
+        """
+        result = self.__run(self.__requests(secret='wrong'))
+        # all requests come from the same address
+        auth.address_failures.clear()
+        auth.credential_failures.clear()
+        return result
+
+    def scenario_concurrent(self) -> Dict:
+        """
+        Many hosts polling at the same time with a cold authentication cache. Failed requests are counted as errors.
+        An in-memory SQLite database locks whole tables for concurrent writes without waiting for them, so the
+        result is only meaningful on a database file (with a busy timeout) or another database.
+        """
+        auth.auth_cache.clear()
+        result = self.__run_concurrent(self.__requests())
+        lastseen.last_seen.flush()
+        result['concurrency'] = self.concurrency
+        if result['errors'] and connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            result['warning'] = "unreliable on an in-memory SQLite database, most errors are table locks: " \
+                                "run it with --db file"
+        return result
+
+    def scenario_dispatch(self) -> Dict:
+        """
+        Drain the queued pushes to the stub server with one worker thread and with `concurrency` threads; the same
+        tasks are queued again for the second run. Use --delay to see the effect of the concurrency.
+        """
+        queued = list(UpdateTask.objects.values_list('record_id', 'family', 'ip'))
+        result = {'tasks': len(queued)}
+        for name, workers in (('sequential', 1), ('concurrent', self.concurrency)):
+            UpdateTask.objects.all().delete()
+            now = timezone.now()
+            UpdateTask.objects.bulk_create([UpdateTask(record_id=record_id, family=family, ip=ip, not_before=now)
+                                            for record_id, family, ip in queued], batch_size=500)
+            requests = self.stub.requests
+            start = time.perf_counter()
+            while dispatch_pending(batch_size=1000, workers=workers):
+                pass
+            wall = time.perf_counter() - start
+            result[name] = {
+                'workers': workers,
+                'upstream_requests': self.stub.requests - requests,
+                'seconds': round(wall, 6),
+                'tasks_per_second': round(len(queued) / wall, 1) if wall else None,
+            }
+        return result
+
+    def scenario_compose(self) -> Dict:
+        """
+        Effective IPv6 addresses of 100k records with the integer engine and with the ipaddress module.
+        """
+        host = "2001:db8:1234:5678::1"
+        compositions = [(64, "::{:x}".format(i % 5000 + 1)) for i in range(100000)]
+
+        start = time.perf_counter()
+        effective_ipv6_many(host, compositions)
+        engine = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for netmask, host_id in compositions:
+            network = IPv6Network("{}/{}".format(host, netmask), strict=False).network_address
+            str(network + (int(IPv6Address(host_id)) & ((1 << 128 - netmask) - 1)))
+        reference = time.perf_counter() - start
+
+        return {'records': len(compositions), 'engine_seconds': round(engine, 6),
+                'ipaddress_seconds': round(reference, 6)}
+
+    def scenario_hashers(self) -> Dict:
+        """
+        Cost of a secret check without the authentication cache, for the default Django hasher and HMAC-SHA256.
+        """
+        result = {}
+        for hasher, count in ((get_hasher('default'), 20), (auth.HostSecretHasher(), 10000)):
+            encoded = make_password(SECRET, hasher=hasher)
+            start = time.perf_counter()
+            for _ in range(count):
+                auth.verify_secret(SECRET, encoded)
+            result[hasher.algorithm + '_us'] = round((time.perf_counter() - start) / count * 1000000, 3)
+        return result
+
+    def scenario_admin(self) -> Dict:
+        """
+        Render the changelists, change and add pages of hosts and records, run with --hosts 10000 to see them with
+        100k records.
+        """
+        user = get_user_model().objects.create_superuser('benchmark', 'benchmark@example.com', None)
+        host = Host.objects.order_by('pk').first()
+        record = Record.objects.order_by('pk').first()
+        pages = {
+            'host_changelist': reverse('admin:ddnsbroker_host_changelist'),
+            'host_search': reverse('admin:ddnsbroker_host_changelist') + '?q=host1',
+            'host_change': reverse('admin:ddnsbroker_host_change', args=(host.pk,)),
+            'record_changelist': reverse('admin:ddnsbroker_record_changelist'),
+            'record_service': '{}?service__id__exact={}'.format(
+                reverse('admin:ddnsbroker_record_changelist'), record.service_id),
+            'record_change': reverse('admin:ddnsbroker_record_change', args=(record.pk,)),
+            'record_add': reverse('admin:ddnsbroker_record_add'),
+        }
+
+        result = {}
+        for name, url in pages.items():
+            match = resolve(url.split('?')[0])
+            durations, queries, errors = [], [], 0
+            start = time.perf_counter()
+            for _ in range(ADMIN_VIEWS):
+                request = self.factory.get(url)
+                request.user = user
+                request_start = time.perf_counter()
+                with CaptureQueriesContext(connection) as context:
+                    response = match.func(request, *match.args, **match.kwargs)
+                    response.render()
+                durations.append(time.perf_counter() - request_start)
+                queries.append(len(context))
+                errors += response.status_code != 200
+            result[name] = summarize(durations, time.perf_counter() - start, queries, errors)
+        result['rows'] = {'hosts': Host.objects.count(), 'records': Record.objects.count()}
+        return result
+
+    SCENARIOS = ('nochg', 'ipchange', 'badauth', 'concurrent', 'dispatch', 'compose', 'hashers', 'admin')
+
+    def run(self, scenarios=SCENARIOS) -> Dict[str, Dict]:
+        self.setup()
+        return {name: getattr(self, 'scenario_' + name)() for name in scenarios}
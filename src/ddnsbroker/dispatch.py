@@ -0,0 +1,403 @@
+"""
+Draining of the UpdateTask queue, i.e. the actual dyndns2 pushes to the update services.
+
+Failed pushes are retried with exponential backoff and jitter until DDNSBROKER_RETRY_MAX_ATTEMPTS is reached. Every
+update service has a circuit breaker: after DDNSBROKER_BREAKER_THRESHOLD requests in a row without a reply, the service
+is not contacted for DDNSBROKER_BREAKER_COOLDOWN seconds, then a single request probes whether it is back.
+
+The replies are handled by their dyndns2 code: records with a configuration error (e.g. "nohost" or "badauth") are
+marked with Record.update_error and not pushed again until they are saved, and a service that reports a problem
+(e.g. "911") gets its circuit breaker opened for DDNSBROKER_SERVICE_BACKOFF seconds. Requests to services with a
+rate limit are spread out with a token bucket.
+
+Settings:
+    DDNSBROKER_SERVICE_BACKOFF: seconds no requests are sent to a service after it reported a problem (default: 1800)
+    DDNSBROKER_RETRY_BASE: seconds before the first retry (default: 30)
+    DDNSBROKER_RETRY_MAX_DELAY: maximum seconds between retries (default: 3600)
+    DDNSBROKER_RETRY_MAX_ATTEMPTS: failed pushes after which a task is dropped (default: 10)
+    DDNSBROKER_BREAKER_THRESHOLD: failed requests in a row that open the circuit breaker of a service (default: 5)
+    DDNSBROKER_BREAKER_COOLDOWN: seconds the circuit breaker stays open (default: 300)
+    DDNSBROKER_METRICS_QUEUE_TTL: seconds the queue metrics are cached between scrapes (default: 15)
+"""
+
+import logging
+import operator
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import reduce
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from ddnsbroker import dyndns2, history, hostcache, metrics
+from ddnsbroker.models import Host, Record, UpdateEvent, UpdateJobItem, UpdateService, UpdateTask
+from ddnsbroker.tools.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    Exponential backoff with jitter: a random delay between half and all of base * 2 ^ (attempts - 1), capped.
+    """
+    base = getattr(settings, 'DDNSBROKER_RETRY_BASE', 30)
+    cap = getattr(settings, 'DDNSBROKER_RETRY_MAX_DELAY', 3600)
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = timedelta(seconds=cooldown)
+        self.failures = 0
+        self.open_until: Optional[datetime] = None
+        self.probing = False
+
+    def state(self, now: datetime) -> str:
+        if self.open_until is None:
+            return self.CLOSED
+        if now < self.open_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self, now: datetime) -> bool:
+        """
+        Whether a request may be sent, only one at a time while half-open.
+        """
+        state = self.state(now)
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def retry_at(self, now: datetime) -> datetime:
+        """
+        When postponed requests may be sent, right away while half-open as the probe is done by then.
+        """
+        if self.open_until is not None and self.open_until > now:
+            return self.open_until
+        return now
+
+    def trip(self, now: datetime, seconds: float) -> None:
+        """
+        Open the breaker right away, e.g. because the service asked us to back off.
+        """
+        self.probing = False
+        self.failures = max(self.failures, self.threshold)
+        self.open_until = now + timedelta(seconds=seconds)
+        logger.warning("circuit breaker open: {} (for {} seconds)".format(self.name, seconds))
+
+    def record(self, success: bool, now: datetime) -> None:
+        self.probing = False
+        if success:
+            if self.open_until is not None:
+                logger.info("circuit breaker closed: {}".format(self.name))
+            self.failures = 0
+            self.open_until = None
+            return
+
+        self.failures += 1
+        if self.open_until is not None or self.failures >= self.threshold:
+            if self.open_until is None or now >= self.open_until:
+                logger.warning("circuit breaker open: {} ({} failed requests)".format(self.name, self.failures))
+            self.open_until = now + self.cooldown
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` requests per minute on average, with bursts of up to `rate` requests.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(float(self.rate), self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self) -> timedelta:
+        """
+        Time until the next token is available.
+        """
+        return timedelta(seconds=max(0.0, (1 - self.tokens) * 60 / self.rate))
+
+
+_breakers: Dict[int, CircuitBreaker] = {}
+_buckets: Dict[int, TokenBucket] = {}
+
+
+def get_breaker(service: UpdateService) -> CircuitBreaker:
+    breaker = _breakers.get(service.pk)
+    if breaker is None:
+        breaker = CircuitBreaker(
+            service.name,
+            threshold=getattr(settings, 'DDNSBROKER_BREAKER_THRESHOLD', 5),
+            cooldown=getattr(settings, 'DDNSBROKER_BREAKER_COOLDOWN', 300))
+        _breakers[service.pk] = breaker
+    return breaker
+
+
+def get_bucket(service: UpdateService) -> Optional[TokenBucket]:
+    if not service.rate_limit:
+        _buckets.pop(service.pk, None)
+        return None
+    bucket = _buckets.get(service.pk)
+    if bucket is None or bucket.rate != service.rate_limit:
+        bucket = TokenBucket(service.rate_limit)
+        _buckets[service.pk] = bucket
+    return bucket
+
+
+def breaker_states() -> Dict[str, str]:
+    now = timezone.now()
+    return {breaker.name: breaker.state(now) for breaker in _breakers.values()}
+
+
+def queue_stats() -> Dict[str, int]:
+    """
+    Number of queued tasks, of those due now and of those that already failed at least once.
+    """
+    return UpdateTask.objects.aggregate(
+        depth=Count('pk'),
+        due=Count('pk', filter=Q(not_before__lte=timezone.now())),
+        retrying=Count('pk', filter=Q(attempts__gt=0)))
+
+
+# a scrape reads the queue at most every DDNSBROKER_METRICS_QUEUE_TTL seconds
+_queue_stats = LRUCache(maxsize=1, ttl=getattr(settings, 'DDNSBROKER_METRICS_QUEUE_TTL', 15))
+
+
+@metrics.register_collector
+def _collect():
+    stats = _queue_stats.get('stats')
+    if stats is None:
+        stats = queue_stats()
+        _queue_stats.set('stats', stats)
+    now = timezone.now()
+    lines = metrics.gauge('ddnsbroker_queue_tasks', "Queued update tasks: all, due now and retrying.", [
+        ({'state': state}, stats[state]) for state in ('depth', 'due', 'retrying')])
+    lines += metrics.gauge('ddnsbroker_circuit_breaker_state', "Circuit breaker state per update service.", [
+        ({'service': breaker.name, 'state': state}, 1 if breaker.state(now) == state else 0)
+        for breaker in _breakers.values()
+        for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)])
+    return lines
+
+
+def _is_enabled(task: UpdateTask) -> bool:
+    if task.record.update_error:
+        return False
+    if task.family == UpdateTask.IPV4:
+        return task.record.ipv4_enabled
+    return task.record.ipv6_enabled
+
+
+def _group(tasks: List[UpdateTask]) -> List[List[UpdateTask]]:
+    """
+    Group tasks that can be sent in one request, i.e. with same service, credentials and ip.
+    """
+    groups: Dict[tuple, List[UpdateTask]] = OrderedDict()
+    for task in tasks:
+        record = task.record
+        groups.setdefault((record.service_id, record.username, record.password, task.ip), []).append(task)
+
+    chunks = []
+    for group in groups.values():
+        size = group[0].record.service.max_hostnames
+        chunks += [group[i:i + size] for i in range(0, len(group), size)]
+    return chunks
+
+
+def _push(group: List[UpdateTask], semaphore: threading.Semaphore) -> List[Optional[str]]:
+    record = group[0].record
+    hostnames = [task.record.fqdn for task in group]
+    with semaphore:
+        return dyndns2.update(record.service, record.username, record.password, hostnames, group[0].ip)
+
+
+def dispatch_tasks(tasks: List[UpdateTask], workers: int = 8) -> int:
+    """
+    Push the given tasks concurrently and write the results back in bulk.
+
+    Tasks with the same service, credentials and ip are coalesced into multi-hostname requests.
+    The number of parallel requests per update service is limited by UpdateService.concurrency.
+    :return: number of successful pushes
+    """
+    now = timezone.now()
+
+    disabled = [task for task in tasks if not _is_enabled(task)]
+    tasks = [task for task in tasks if _is_enabled(task)]
+
+    semaphores: Dict[int, threading.Semaphore] = {}
+    for task in tasks:
+        service = task.record.service
+        if service.pk not in semaphores:
+            semaphores[service.pk] = threading.BoundedSemaphore(service.concurrency)
+
+    # tasks of services with an open circuit breaker wait until it may be half-open,
+    # tasks of services without tokens left until the next token is available
+    groups, postponed = [], []
+    for group in _group(tasks):
+        service = group[0].record.service
+        breaker = get_breaker(service)
+        bucket = get_bucket(service)
+        if not breaker.allow(now):
+            not_before = breaker.retry_at(now)
+        elif bucket is not None and not bucket.take():
+            breaker.probing = False
+            not_before = now + bucket.wait()
+        else:
+            groups.append(group)
+            continue
+        for task in group:
+            task.not_before = not_before
+        postponed += group
+
+    tasks, replies = [], []
+    tripped = set()
+    if groups:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_push, group, semaphores[group[0].record.service_id]) for group in groups]
+            for group, future in zip(groups, futures):
+                group_replies = future.result()
+                service = group[0].record.service
+                codes = {dyndns2.reply_code(reply) for reply in group_replies}
+                if codes & set(dyndns2.SERVICE_ERROR_CODES):
+                    get_breaker(service).trip(now, getattr(settings, 'DDNSBROKER_SERVICE_BACKOFF', 1800))
+                    tripped.add(service.pk)
+                elif service.pk not in tripped:
+                    # any reply, even an error code, means the service is up
+                    get_breaker(service).record(codes != {None}, now)
+                tasks += group
+                replies += group_replies
+
+    now = timezone.now()
+    max_attempts = getattr(settings, 'DDNSBROKER_RETRY_MAX_ATTEMPTS', 10)
+    succeeded, failed, exhausted = [], [], []
+    blocked: Dict[str, List[UpdateTask]] = {}
+    # (task, result, finished) for the items of update jobs
+    results = [(task, task.record.update_error or 'disabled', True) for task in disabled]
+    for task, reply in zip(tasks, replies):
+        code = dyndns2.reply_code(reply)
+        if code in dyndns2.SUCCESS_CODES:
+            succeeded.append(task)
+            results.append((task, code, True))
+            continue
+        if code in dyndns2.RECORD_ERROR_CODES:
+            logger.error("stopping updates of {} until it is saved again: {}".format(task.record.fqdn, code))
+            blocked.setdefault(code, []).append(task)
+            results.append((task, code, True))
+            continue
+        if code in dyndns2.SERVICE_ERROR_CODES:
+            # not the fault of the task, it waits for the circuit breaker
+            task.not_before = get_breaker(task.record.service).retry_at(now)
+            postponed.append(task)
+            results.append((task, code, False))
+            continue
+        task.attempts += 1
+        if task.attempts >= max_attempts:
+            logger.error("giving up update after {} attempts: {} {}".format(task.attempts, task.record.fqdn, task.ip))
+            exhausted.append(task)
+            results.append((task, code or 'error', True))
+        else:
+            task.not_before = now + retry_delay(task.attempts)
+            failed.append(task)
+            results.append((task, code or 'error', False))
+
+    # only if the pushed address is still the address of the record, else the newer one is queued and not pushed yet
+    for family, field in ((UpdateTask.IPV4, 'ipv4'), (UpdateTask.IPV6, 'ipv6')):
+        pushed = [Q(pk=task.record_id, **{'effective_' + field: task.ip})
+                  for task in succeeded if task.family == family]
+        if pushed:
+            Record.objects.filter(reduce(operator.or_, pushed)).update(**{'last_{}_update'.format(field): now})
+
+    for code, blocked_tasks in blocked.items():
+        Record.objects.filter(pk__in=[task.record_id for task in blocked_tasks]).update(update_error=code)
+        disabled += blocked_tasks
+
+    if blocked:
+        # cached records would still be pushed
+        hostcache.delete(*Host.objects.filter(record__in=[task.record_id for task in disabled])
+                         .values_list('fqdn', flat=True).distinct())
+
+    if disabled:
+        logger.debug("dropping updates of disabled records: {}".format([task.record.fqdn for task in disabled]))
+        _delete_done(disabled, same_ip=False)
+
+    _delete_done(succeeded + exhausted)
+
+    if failed or postponed:
+        current = set(UpdateTask.objects.filter(
+            pk__in=[task.pk for task in failed + postponed]).values_list('pk', 'ip'))
+        rescheduled = [task for task in failed + postponed if (task.pk, task.ip) in current]
+        UpdateTask.objects.bulk_update(rescheduled, ['attempts', 'not_before'], batch_size=500)
+
+    UpdateJobItem.record_results(results, now=now)
+    for task, result, finished in results:
+        history.record(UpdateEvent.push(task, result, now))
+
+    return len(succeeded)
+
+
+def _delete_done(tasks: List[UpdateTask], same_ip: bool = True, chunk_size: int = 500) -> None:
+    """
+    Delete the tasks, if same_ip only those that still have the pushed ip: a task may have been replaced with a newer
+    ip in the meantime, which still has to be pushed.
+    The job of a deleted task is read again, an update job may have taken over the task while it was pushed.
+    """
+    for start in range(0, len(tasks), chunk_size):
+        chunk = tasks[start:start + chunk_size]
+        with transaction.atomic():
+            current = {pk: (ip, job_id) for pk, ip, job_id in UpdateTask.objects.select_for_update().filter(
+                pk__in=[task.pk for task in chunk]).values_list('pk', 'ip', 'job_id')}
+            done = [task for task in chunk if task.pk in current and (not same_ip or current[task.pk][0] == task.ip)]
+            UpdateTask.objects.filter(pk__in=[task.pk for task in done]).delete()
+        for task in done:
+            task.job_id = current[task.pk][1]
+
+
+def requeue_missed() -> int:
+    """
+    Queue the pushes of records that need one but have no queued task, e.g. because it was dropped after
+    DDNSBROKER_RETRY_MAX_ATTEMPTS. Reads only the records needing a push.
+    :return: number of queued pushes
+    """
+    pending = []
+    for family in (UpdateTask.IPV4, UpdateTask.IPV6):
+        queued = UpdateTask.objects.filter(family=family).values('record_id')
+        records = Record.needing_push(family).exclude(pk__in=queued).select_related('host')
+        pending += [update for record in records for update in record.pending_updates() if update[1] == family]
+    UpdateTask.enqueue_many(pending)
+    return len(pending)
+
+
+def dispatch_pending(batch_size: int = 100, workers: int = 8) -> int:
+    """
+    Push the oldest batch of due tasks.
+    :return: number of processed tasks
+    """
+    tasks = list(UpdateTask.objects.filter(not_before__lte=timezone.now())
+                 .select_related('record__service').order_by('not_before')[:batch_size])
+    dispatch_tasks(tasks, workers=workers)
+    return len(tasks)
@@ -0,0 +1,159 @@
+"""
+HTTP client side of the dyndns2 protocol, i.e. the connections to the update services.
+"""
+
+import logging
+import threading
+from typing import Dict, List, Optional
+
+import requests
+from requests import RequestException
+from requests.adapters import HTTPAdapter
+
+from ddnsbroker import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceSession(object):
+    """
+    A keep-alive session to one update service with its own connection pool.
+    """
+
+    def __init__(self, service):
+        self.key = (service.url, service.pool_size, service.timeout)
+        self.name = service.name
+        self.timeout = service.timeout
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=service.pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.requests = 0
+        self.__lock = threading.Lock()
+
+    def get(self, url, **kwargs) -> requests.Response:
+        with self.__lock:
+            self.requests += 1
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    @property
+    def connections(self) -> int:
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_sessions: Dict[int, ServiceSession] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(service) -> ServiceSession:
+    """
+    Get the session of an update service, it is recreated if the service settings changed.
+    """
+    with _sessions_lock:
+        session = _sessions.get(service.pk)
+        if session is None or session.key != (service.url, service.pool_size, service.timeout):
+            if session is not None:
+                session.close()
+            session = ServiceSession(service)
+            _sessions[service.pk] = session
+        return session
+
+
+def session_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Request and connection counters per update service.
+    Every request that did not need a new connection saved a TCP (and TLS) handshake.
+    """
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+
+    stats = {}
+    for session in sessions:
+        requests_count, connections = session.requests, session.connections
+        stats[session.name] = {
+            'requests': requests_count,
+            'connections': connections,
+            'handshakes_avoided': max(requests_count - connections, 0),
+        }
+    return stats
+
+
+SUCCESS_CODES = ('good', 'nochg')
+
+# the record configuration is wrong or it is blocked, retrying will not help
+RECORD_ERROR_CODES = ('badauth', 'notfqdn', 'nohost', 'numhost', 'abuse', '!yours', '!donator')
+
+# the service has problems or rejects us, no requests should be sent for a while
+SERVICE_ERROR_CODES = ('911', 'dnserr', 'badagent')
+
+
+def reply_code(reply: Optional[str]) -> Optional[str]:
+    if not reply:
+        return None
+    return reply.split()[0]
+
+
+def is_success(reply: Optional[str]) -> bool:
+    return reply_code(reply) in SUCCESS_CODES
+
+
+def update(service, username: str, password: str, hostnames: List[str], ip: str) -> List[Optional[str]]:
+    """
+    Send one dyndns2 update request for one or more hostnames that share the credentials and ip.
+    :return: the reply line for every hostname, None if there was no usable reply
+    """
+    params = {
+        'hostname': ",".join(hostnames),
+        'myip': ip
+    }
+    auth = (username, password)
+
+    logger.debug("update request: {} {}".format(service.url, params))
+
+    try:
+        with metrics.UPSTREAM_SECONDS.time(service.name):
+            r = get_session(service).get(service.url, params=params, auth=auth)
+            r.close()
+    except RequestException:
+        logger.error("update connection error: {} {}".format(service.url, params))
+        metrics.UPSTREAM_REPLIES.inc(service.name, 'error', amount=len(hostnames))
+        return [None] * len(hostnames)
+
+    text = r.text.strip()
+    code = r.status_code
+
+    if code != 200:
+        logger.error("update response error: {} {} -> {} {}".format(service.url, params, code, text))
+        metrics.UPSTREAM_REPLIES.inc(service.name, 'error', amount=len(hostnames))
+        return [None] * len(hostnames)
+
+    lines = [line.strip() for line in text.splitlines()]
+    if len(lines) == 1:
+        # one reply for the whole request, e.g. "badauth"
+        lines = lines * len(hostnames)
+    elif len(lines) != len(hostnames):
+        logger.error("update response error: {} {} -> {} replies for {} hostnames: {}".format(
+            service.url, params, len(lines), len(hostnames), text))
+        metrics.UPSTREAM_REPLIES.inc(service.name, 'error', amount=len(hostnames))
+        return [None] * len(hostnames)
+
+    for hostname, line in zip(hostnames, lines):
+        metrics.UPSTREAM_REPLIES.inc(service.name, reply_code(line) or 'error')
+        if is_success(line):
+            logger.info("update response success: {} {} {} -> {}".format(service.url, hostname, ip, line))
+        else:
+            logger.error("update response error: {} {} {} -> {}".format(service.url, hostname, ip, line))
+
+    return lines
+
+
+@metrics.register_collector
+def _collect():
+    stats = session_stats()
+    return metrics.gauge(
+        'ddnsbroker_upstream_handshakes_avoided_total', "Update requests that reused a kept-alive connection.",
+        [({'service': name}, values['handshakes_avoided']) for name, values in stats.items()], kind='counter')
@@ -0,0 +1,57 @@
+"""
+Batched writes and retention of the update history, see UpdateEvent.
+
+Events are collected in memory and written with one insert per DDNSBROKER_HISTORY_INTERVAL, so recording them does
+not add a query to /nic/update. Events older than the retention are deleted in primary key ranges, which follow
+the time of the append-only table, by the dispatchupdates worker or the prunehistory command.
+
+Settings:
+    DDNSBROKER_HISTORY: whether address changes and pushes are recorded (default: True)
+    DDNSBROKER_HISTORY_INTERVAL: seconds between the batched writes, 0 writes immediately (default: 10)
+    DDNSBROKER_HISTORY_RETENTION: days the history is kept, 0 keeps it forever (default: 90)
+"""
+
+from datetime import timedelta
+from typing import List
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from ddnsbroker.tools.buffer import WriteBuffer
+
+
+def _flush(events: List) -> None:
+    apps.get_model('ddnsbroker', 'UpdateEvent').objects.bulk_create(events, batch_size=1000)
+
+
+events = WriteBuffer(_flush, interval=getattr(settings, 'DDNSBROKER_HISTORY_INTERVAL', 10))
+
+
+def record(event) -> None:
+    if getattr(settings, 'DDNSBROKER_HISTORY', True):
+        events.append(event)
+
+
+def prune(now=None, chunk_size: int = 10000) -> int:
+    """
+    Delete the events older than the retention.
+    :return: number of deleted events
+    """
+    days = getattr(settings, 'DDNSBROKER_HISTORY_RETENTION', 90)
+    if not days:
+        return 0
+    now = now or timezone.now()
+
+    UpdateEvent = apps.get_model('ddnsbroker', 'UpdateEvent')
+    last = UpdateEvent.objects.filter(time__lt=now - timedelta(days=days)).aggregate(last=Max('pk'))['last']
+    if last is None:
+        return 0
+
+    deleted = 0
+    first = UpdateEvent.objects.order_by('pk').values_list('pk', flat=True).first()
+    for start in range(first, last + 1, chunk_size):
+        count, _ = UpdateEvent.objects.filter(pk__gte=start, pk__lte=min(start + chunk_size - 1, last)).delete()
+        deleted += count
+    return deleted
@@ -0,0 +1,63 @@
+"""
+Cache of hosts with their records and update services, keyed by FQDN, so a host that reports an unchanged address is
+answered without a database query.
+
+Every lookup returns new instances, which can be changed and saved. An entry is deleted when its host, one of its
+records or one of their update services is saved or deleted, and after DDNSBROKER_HOST_CACHE_TTL seconds.
+Hosts are only cached if DDNSBROKER_HOST_CACHE_ALIAS names a cache of Django's cache framework that all processes
+share (e.g. memcached or redis): a per-process cache would miss the changes of other processes (admin, update worker,
+other web workers) and serve, e.g., a revoked secret until its entry expires.
+
+The list of all update services for the admin forms is cached per process with the same TTL.
+
+Settings:
+    DDNSBROKER_HOST_CACHE_TTL: seconds a host is cached (default: 60)
+    DDNSBROKER_HOST_CACHE_ALIAS: alias of a cache in CACHES shared by all processes, None disables the host cache
+        (default: None)
+"""
+
+from typing import Any, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+from ddnsbroker import metrics
+from ddnsbroker.tools.cache import LRUCache
+
+TTL = getattr(settings, 'DDNSBROKER_HOST_CACHE_TTL', 60)
+
+service_cache = LRUCache(maxsize=1, ttl=TTL)
+
+
+def _shared():
+    alias = getattr(settings, 'DDNSBROKER_HOST_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+def enabled() -> bool:
+    return _shared() is not None
+
+
+def _key(fqdn: str) -> str:
+    return "ddnsbroker:host:{}".format(fqdn)
+
+
+def get(fqdn: str) -> Optional[Any]:
+    shared = _shared()
+    if shared is None:
+        return None
+    host = shared.get(_key(fqdn))
+    metrics.HOST_CACHE_LOOKUPS.inc('miss' if host is None else 'hit')
+    return host
+
+
+def set(fqdn: str, host: Any) -> None:
+    shared = _shared()
+    if shared is not None:
+        shared.set(_key(fqdn), host, timeout=TTL)
+
+
+def delete(*fqdns: str) -> None:
+    shared = _shared()
+    if shared is not None:
+        shared.delete_many([_key(fqdn) for fqdn in fqdns])
@@ -0,0 +1,46 @@
+"""
+Batched writes of the last update timestamps of hosts that reported unchanged addresses. A buffered timestamp never
+replaces a newer one, and it is written at most DDNSBROKER_LAST_SEEN_INTERVAL seconds after the report, also if no
+further reports come in.
+
+Settings:
+    DDNSBROKER_LAST_SEEN_INTERVAL: seconds between the batched writes, 0 writes immediately (default: 60)
+"""
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import DateTimeField, F, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from ddnsbroker.models import Host
+from ddnsbroker.tools.buffer import WriteBuffer
+
+
+def _flush(items: List[Tuple[int, Optional[datetime], Optional[datetime]]]) -> None:
+    ipv4, ipv6 = {}, {}
+    for pk, last_ipv4_update, last_ipv6_update in items:
+        if last_ipv4_update is not None:
+            ipv4[pk] = last_ipv4_update
+        if last_ipv6_update is not None:
+            ipv6[pk] = last_ipv6_update
+
+    # a newer timestamp written by Host.save in the meantime is kept
+    for field, timestamps in (('last_ipv4_update', ipv4), ('last_ipv6_update', ipv6)):
+        hosts = []
+        for pk, timestamp in timestamps.items():
+            value = Value(timestamp, output_field=DateTimeField())
+            hosts.append(Host(pk=pk, **{field: Greatest(Coalesce(F(field), value), value)}))
+        if hosts:
+            Host.objects.bulk_update(hosts, [field], batch_size=500)
+
+
+last_seen = WriteBuffer(_flush, interval=getattr(settings, 'DDNSBROKER_LAST_SEEN_INTERVAL', 60))
+
+
+def touch(host: Host, now: datetime, ipv4: bool, ipv6: bool) -> None:
+    """
+    Remember that a host reported its (unchanged) address.
+    """
+    last_seen.append((host.pk, now if ipv4 else None, now if ipv6 else None))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ddnsbroker.audit import audit
+
+
+class Command(BaseCommand):
+    help = "Print the query plans of the hot lookups and fail if one of them scans a whole table (SQLite only)."
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, plan, scans in audit():
+            if options['verbosity'] >= 2 or scans:
+                self.stdout.write("{}:\n{}\n".format(name, plan))
+            if scans:
+                failed.append("{} ({})".format(name, ", ".join(scans)))
+
+        if failed:
+            raise CommandError("full table scans: {}".format("; ".join(failed)))
+        self.stdout.write("all hot queries use an index")
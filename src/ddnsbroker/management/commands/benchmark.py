@@ -0,0 +1,68 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ddnsbroker import history, lastseen
+from ddnsbroker.benchmark import Benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmark the update path on a fresh test database against a local stub update service."
+
+    def add_arguments(self, parser):
+        # no choices, argparse rejects an empty list then
+        parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                            help="Scenarios to run: {} (default: all).".format(", ".join(Benchmark.SCENARIOS)))
+        parser.add_argument('--hosts', type=int, default=100, help="Number of hosts (default: 100).")
+        parser.add_argument('--records', type=int, default=10, help="Number of records per host (default: 10).")
+        parser.add_argument('--requests', type=int, default=1000,
+                            help="Number of requests per scenario (default: 1000).")
+        parser.add_argument('--concurrency', type=int, default=16,
+                            help="Requests in flight in the concurrent scenario and worker threads in the dispatch "
+                                 "scenario (default: 16).")
+        parser.add_argument('--delay', type=float, default=0.0,
+                            help="Seconds the stub update service waits before answering (default: 0).")
+        parser.add_argument('--asgi', action='store_true',
+                            help="Benchmark the async views, called in-process like the sync views, without an ASGI "
+                                 "server.")
+        parser.add_argument('--db', choices=('memory', 'file'), default='memory',
+                            help="Run on an in-memory or on-disk test database (default: memory).")
+        parser.add_argument('--output', help="Write the results to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(Benchmark.SCENARIOS)
+        if unknown:
+            raise CommandError("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+        if options['verbosity'] < 2:
+            # every push is logged at info level, which would measure the log handler
+            logging.getLogger('ddnsbroker').setLevel(logging.WARNING)
+
+        if options['db'] == 'file':
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = 'ddnsbroker_benchmark.sqlite3'
+            if connection.vendor == 'sqlite':
+                # concurrent writers wait for the lock instead of failing
+                connection.settings_dict.setdefault('OPTIONS', {}).setdefault('timeout', 30)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        benchmark = Benchmark(hosts=options['hosts'], records=options['records'], requests=options['requests'],
+                              concurrency=options['concurrency'], asgi=options['asgi'], delay=options['delay'])
+        try:
+            results = benchmark.run(options['scenarios'] or Benchmark.SCENARIOS)
+        finally:
+            benchmark.close()
+            # else the buffers are written at exit, into a new database file with the name of the test database
+            history.events.flush()
+            lastseen.last_seen.flush()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results['options'] = {key: options[key] for key in ('hosts', 'records', 'requests', 'concurrency', 'delay',
+                                                            'asgi', 'db')}
+        results['options']['views'] = "{} views called in-process".format('async' if options['asgi'] else 'sync')
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,57 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from ddnsbroker import history, metrics
+from ddnsbroker.dispatch import breaker_states, dispatch_pending, queue_stats, requeue_missed
+from ddnsbroker.dyndns2 import session_stats
+
+logger = logging.getLogger(__name__)
+
+PRUNE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = "Push queued record updates to their update services."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process a single batch and exit.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds to wait when the queue is empty (default: 5).")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of tasks fetched at once (default: 100).")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Number of parallel update requests (default: 8).")
+        parser.add_argument('--metrics-port', type=int,
+                            help="Serve the metrics of the worker on this port.")
+
+    def handle(self, *args, **options):
+        if options['metrics_port']:
+            metrics.serve(options['metrics_port'])
+
+        logger.info("queued {} missed pushes".format(requeue_missed()))
+
+        last_prune = None
+        while True:
+            try:
+                count = dispatch_pending(batch_size=options['batch_size'], workers=options['workers'])
+                if count:
+                    history.events.flush()
+                    logger.debug("connection stats: {}".format(session_stats()))
+                    logger.debug("queue stats: {}, circuit breakers: {}".format(queue_stats(), breaker_states()))
+                if last_prune is None or time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                    logger.debug("pruned {} history events".format(history.prune()))
+                    last_prune = time.monotonic()
+            except Exception:
+                if options['once']:
+                    raise
+                # e.g. "database is locked", the batch is tried again, a broken connection is opened again
+                logger.exception("dispatching updates failed")
+                connection.close()
+                count = 0
+            if options['once']:
+                break
+            if count < options['batch_size']:
+                time.sleep(options['interval'])
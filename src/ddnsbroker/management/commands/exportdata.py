@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ddnsbroker.transfer import MODELS, export_rows, write_csv, write_jsonl
+
+
+class Command(BaseCommand):
+    help = "Export update services, hosts and records as JSON Lines or CSV, see ddnsbroker.transfer."
+
+    def add_arguments(self, parser):
+        # no choices, argparse rejects an empty list then
+        parser.add_argument('models', nargs='*', metavar='model',
+                            help="Models to export: service, host or record (default: all, in this order).")
+        parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl',
+                            help="JSON Lines or CSV, which holds a single model (default: jsonl).")
+        parser.add_argument('--output', help="Write to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        unknown = set(options['models']) - set(MODELS)
+        if unknown:
+            raise CommandError("unknown models: {}".format(", ".join(sorted(unknown))))
+        models = [model for model in MODELS if model in options['models']] if options['models'] else MODELS
+        if options['format'] == 'csv' and len(models) != 1:
+            raise CommandError("a CSV export holds a single model")
+        write = write_csv if options['format'] == 'csv' else write_jsonl
+
+        stream = open(options['output'], 'w', newline='') if options['output'] else self.stdout
+        try:
+            for model in models:
+                count = write(stream, model, export_rows(model))
+                if options['verbosity'] >= 2:
+                    self.stderr.write("exported {} {} rows".format(count, model))
+        finally:
+            if stream is not self.stdout:
+                stream.close()
@@ -0,0 +1,46 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ddnsbroker import history
+from ddnsbroker.transfer import MODELS, Importer, read_csv, read_jsonl, resync
+
+
+class Command(BaseCommand):
+    help = "Import update services, hosts and records from JSON Lines or CSV, see ddnsbroker.transfer. " \
+           "Pushes are queued once for all imported records."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, - for stdin.")
+        parser.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl',
+                            help="JSON Lines or CSV (default: jsonl).")
+        parser.add_argument('--model', choices=MODELS, help="Model of the rows of a CSV file.")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="Number of rows validated and written at once (default: 1000).")
+        parser.add_argument('--workers', type=int,
+                            help="Number of processes hashing plaintext secrets, 0 hashes them in this process "
+                                 "(default: number of CPUs).")
+
+    def handle(self, *args, **options):
+        if options['format'] == 'csv' and options['model'] is None:
+            raise CommandError("--model is required for CSV")
+
+        def error(line_number, message):
+            self.stderr.write("line {}: {}".format(line_number, message))
+
+        importer = Importer(chunk_size=options['chunk_size'], workers=options['workers'], error=error)
+        stream = sys.stdin if options['path'] == '-' else open(options['path'], newline='')
+        try:
+            rows = read_csv(stream, options['model']) if options['format'] == 'csv' else read_jsonl(stream)
+            stats = importer.run(rows)
+        finally:
+            importer.close()
+            if stream is not sys.stdin:
+                stream.close()
+        history.events.flush()
+
+        queued = resync(chunk_size=options['chunk_size'])
+        self.stdout.write("{created} created, {updated} updated, {unchanged} unchanged, {errors} errors, "
+                          "{queued} pushes pending".format(queued=queued, **stats))
+        if stats['errors']:
+            raise CommandError("{} rows were not imported".format(stats['errors']))
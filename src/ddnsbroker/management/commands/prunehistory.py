@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from ddnsbroker import history
+
+
+class Command(BaseCommand):
+    help = "Delete the update history older than DDNSBROKER_HISTORY_RETENTION days."
+
+    def handle(self, *args, **options):
+        self.stdout.write("deleted {} events".format(history.prune()))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ddnsbroker.reconcile import reconcile
+from ddnsbroker.tools.resolver import Resolver
+
+
+class Command(BaseCommand):
+    help = "Resolve all records and queue pushes of the records that do not resolve to their effective addresses."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nameserver',
+                            help="Name server to ask, preferably the authoritative one (default: from resolv.conf).")
+        parser.add_argument('--port', type=int, default=53, help="Port of the name server (default: 53).")
+        parser.add_argument('--timeout', type=float, default=2.0,
+                            help="Seconds to wait for an answer (default: 2).")
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help="Number of parallel lookups (default: 50).")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of records loaded at once (default: 500).")
+        parser.add_argument('--dry-run', action='store_true', help="Only report, do not queue pushes.")
+
+    def handle(self, *args, **options):
+        resolver = Resolver(nameserver=options['nameserver'], port=options['port'], timeout=options['timeout'])
+
+        def progress(stats):
+            if options['verbosity'] >= 2:
+                self.stdout.write("checked {checked} lookups of {records} records: {matching} matching, "
+                                  "{differing} differing, {failed} failed".format(**stats))
+
+        stats = reconcile(resolver, batch_size=options['batch_size'], concurrency=options['concurrency'],
+                          dry_run=options['dry_run'], progress=progress)
+
+        self.stdout.write("{checked} lookups of {records} records: {matching} matching, {differing} differing, "
+                          "{failed} failed, {queued} pushes queued".format(**stats))
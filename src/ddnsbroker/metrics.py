@@ -0,0 +1,177 @@
+"""
+In-process metrics in the Prometheus text format, served at /metrics and by ``dispatchupdates --metrics-port``.
+
+Metrics are kept per process: the web processes export the /nic/update phases and response codes, the dispatch
+worker exports the upstream requests. Recording a value is a dictionary update under a lock.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.__values: Dict[Tuple[str, ...], float] = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.__lock:
+            self.__values[labels] = self.__values.get(labels, 0) + amount
+
+    def collect(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        with self.__lock:
+            values = sorted(self.__values.items())
+        for labels, value in values:
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label values: count per bucket (the last one is +Inf), sum
+        self.__values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            counts, total = self.__values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def collect(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        with self.__lock:
+            values = sorted((labels, (list(counts), total[0])) for labels, (counts, total) in self.__values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format("+Inf" if bound == float('inf') else bound)
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, labels, le), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, labels), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+def gauge(name: str, documentation: str, samples: List[Tuple[Dict[str, str], float]], kind: str = 'gauge') -> List[str]:
+    """
+    Format values that are read at collection time.
+    """
+    lines = ["# HELP {} {}".format(name, documentation), "# TYPE {} {}".format(name, kind)]
+    for labels, value in samples:
+        lines.append("{}{} {}".format(name, _format_labels(tuple(labels.keys()), tuple(labels.values())), value))
+    return lines
+
+
+_metrics = []
+_collectors: List[Callable[[], List[str]]] = []
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(collector: Callable[[], List[str]]) -> Callable[[], List[str]]:
+    _collectors.append(collector)
+    return collector
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines += metric.collect()
+    for collector in _collectors:
+        lines += collector()
+    return "\n".join(lines) + "\n"
+
+
+def serve(port: int, address: str = '') -> ThreadingHTTPServer:
+    """
+    Serve the metrics of this process in a background thread, for processes without a web server.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+PHASE_SECONDS = register(Histogram(
+    'ddnsbroker_phase_seconds', "Duration of the phases of an update: auth, hash, save, propagate.", ('phase',)))
+
+NIC_UPDATE_SECONDS = register(Histogram(
+    'ddnsbroker_nic_update_seconds', "Duration of /nic/update requests."))
+
+NIC_UPDATE_RESPONSES = register(Counter(
+    'ddnsbroker_nic_update_responses_total', "Replies to host updates by dyndns2 code.", ('code',)))
+
+UPSTREAM_SECONDS = register(Histogram(
+    'ddnsbroker_upstream_request_seconds', "Duration of update requests to the update services.", ('service',)))
+
+UPSTREAM_REPLIES = register(Counter(
+    'ddnsbroker_upstream_replies_total',
+    "Replies of the update services per hostname by dyndns2 code, 'error' if there was no usable reply.",
+    ('service', 'code')))
+
+AUTH_CACHE_LOOKUPS = register(Counter(
+    'ddnsbroker_auth_cache_lookups_total', "Secret checks answered (hit) or not (miss) by the credentials cache.",
+    ('result',)))
+
+PUSHES_COLLAPSED = register(Counter(
+    'ddnsbroker_pushes_collapsed_total', "Queued pushes replaced by a newer address before they were tried."))
+
+HOST_CACHE_LOOKUPS = register(Counter(
+    'ddnsbroker_host_cache_lookups_total', "Host lookups answered (hit) or not (miss) by the host cache.",
+    ('result',)))
+
+BADAUTH_FAILURES = register(Counter(
+    'ddnsbroker_badauth_failures_total', "Checks of credentials that failed."))
+
+BADAUTH_REJECTIONS = register(Counter(
+    'ddnsbroker_badauth_rejections_total',
+    "Requests answered with badauth without a check, because of failures of the credentials or the client address.",
+    ('key',)))
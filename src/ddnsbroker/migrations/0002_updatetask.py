@@ -0,0 +1,30 @@
+# Generated by Django 3.1.14 on 2026-10-17 21:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpdateTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('family', models.PositiveSmallIntegerField(choices=[(4, 'IPv4'), (6, 'IPv6')])),
+                ('ip', models.GenericIPAddressField(verbose_name='IP')),
+                ('attempts', models.PositiveIntegerField(default=0, editable=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ddnsbroker.record')),
+            ],
+            options={
+                'ordering': ('attempts', 'created'),
+                'unique_together': {('record', 'family')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0002_updatetask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='updateservice',
+            name='concurrency',
+            field=models.PositiveSmallIntegerField(default=4, help_text='Maximum number of parallel update requests to this service.', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0003_updateservice_concurrency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='updateservice',
+            name='pool_size',
+            field=models.PositiveSmallIntegerField(default=10, help_text='Maximum number of kept-alive connections to this service.', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='updateservice',
+            name='timeout',
+            field=models.PositiveSmallIntegerField(default=30, help_text='Timeout of update requests in seconds.', validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:01
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0004_updateservice_pool_size_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='updateservice',
+            name='max_hostnames',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Maximum number of comma-separated hostnames per update request. Set to 1 if the service does not support multiple hostnames.', validators=[django.core.validators.MinValueValidator(1)], verbose_name='max. hostnames'),
+        ),
+    ]
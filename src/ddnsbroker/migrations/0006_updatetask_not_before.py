@@ -0,0 +1,19 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0005_updateservice_max_hostnames'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='updatetask',
+            name='not_before',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
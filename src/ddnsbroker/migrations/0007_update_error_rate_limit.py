@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0006_updatetask_not_before'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='update_error',
+            field=models.CharField(blank=True, editable=False, help_text='Error code of the update service, no updates are sent until the record is saved again.', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='updateservice',
+            name='rate_limit',
+            field=models.PositiveIntegerField(default=0, help_text='Maximum number of update requests per minute. Set to 0 for no limit.'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0007_update_error_rate_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='debounce',
+            field=models.PositiveIntegerField(default=0, help_text='Seconds to wait before pushing a changed address. Further changes in this time are merged, only the last address is pushed.'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0008_host_debounce'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpdateJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+            options={
+                'ordering': ('-created',),
+            },
+        ),
+        migrations.AddField(
+            model_name='updatetask',
+            name='job',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='ddnsbroker.updatejob'),
+        ),
+        migrations.CreateModel(
+            name='UpdateJobItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('family', models.PositiveSmallIntegerField(choices=[(4, 'IPv4'), (6, 'IPv6')])),
+                ('ip', models.GenericIPAddressField(verbose_name='IP')),
+                ('result', models.CharField(blank=True, help_text="Reply code of the last try, 'error' if there was no usable reply.", max_length=16)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='ddnsbroker.updatejob')),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ddnsbroker.record')),
+            ],
+            options={
+                'ordering': ('job', 'record', 'family'),
+                'unique_together': {('job', 'record', 'family')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0009_updatejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpdateEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'address change'), (2, 'push')])),
+                ('family', models.PositiveSmallIntegerField(choices=[(4, 'IPv4'), (6, 'IPv6')])),
+                ('address', models.BinaryField(max_length=16)),
+                ('result', models.PositiveSmallIntegerField(blank=True, choices=[(1, 'good'), (2, 'nochg'), (3, 'error'), (4, 'disabled'), (5, 'badauth'), (6, 'notfqdn'), (7, 'nohost'), (8, 'numhost'), (9, 'abuse'), (10, '!yours'), (11, '!donator'), (12, '911'), (13, 'dnserr'), (14, 'badagent')], null=True)),
+                ('host', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='ddnsbroker.host')),
+                ('record', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='ddnsbroker.record')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='updateevent',
+            index=models.Index(fields=['host', 'time'], name='ddnsbroker_event_host_time'),
+        ),
+    ]
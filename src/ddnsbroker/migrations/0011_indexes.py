@@ -0,0 +1,32 @@
+# Generated by Django 3.1.14 on 2026-10-17 22:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ddnsbroker', '0010_updateevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='record',
+            name='service',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to='ddnsbroker.updateservice'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['service', 'host', 'fqdn'], name='ddnsbroker_record_service'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(condition=models.Q(('effective_ipv4__isnull', False), models.Q(('last_ipv4_update__isnull', True), ('last_ipv4_change__gt', django.db.models.expressions.F('last_ipv4_update')), _connector='OR')), fields=['id'], name='ddnsbroker_record_ipv4_push'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(condition=models.Q(('effective_ipv6__isnull', False), models.Q(('last_ipv6_update__isnull', True), ('last_ipv6_change__gt', django.db.models.expressions.F('last_ipv6_update')), _connector='OR')), fields=['id'], name='ddnsbroker_record_ipv6_push'),
+        ),
+    ]
@@ -1,13 +1,17 @@
 import logging
-from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, AddressValueError
+from datetime import timedelta
+from ipaddress import IPv4Address, IPv6Address, AddressValueError, ip_address
+from typing import Dict, List, Optional, Tuple
 
-import requests
 from django.contrib.auth import get_user_model
-from django.contrib.auth.hashers import make_password, check_password
-from django.core.validators import RegexValidator, MaxValueValidator, URLValidator
-from django.db import models
+from django.core.validators import RegexValidator, MaxValueValidator, MinValueValidator, URLValidator
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
-from requests import ConnectionError
+
+from ddnsbroker import auth, dyndns2, history, hostcache, metrics
+from ddnsbroker.tools.ip import effective_ipv4, effective_ipv4_many, effective_ipv6, effective_ipv6_many
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +29,7 @@ class Host(models.Model):
         ],
         unique=True,
         help_text="Is also used as HTTP Basic Auth username.")
+    __original_fqdn = None
 
     secret = models.CharField(max_length=128, help_text="Will be hashed if changed.")
     __original_secret = None
@@ -42,6 +47,11 @@ class Host(models.Model):
     last_ipv4_change = models.DateTimeField(null=True, blank=True, editable=False)
     last_ipv6_change = models.DateTimeField(null=True, blank=True, editable=False)
 
+    debounce = models.PositiveIntegerField(
+        default=0,
+        help_text="Seconds to wait before pushing a changed address. Further changes in this time are merged, "
+                  "only the last address is pushed.")
+
     created = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -50,9 +60,15 @@ class Host(models.Model):
     class Meta(object):
         ordering = ('fqdn',)
 
+    UPDATE_FIELDS = ('ipv4', 'ipv6', 'last_ipv4_update', 'last_ipv6_update', 'last_ipv4_change', 'last_ipv6_change')
+
     def __init__(self, *args, **kwargs):
         super(Host, self).__init__(*args, **kwargs)
+        self.__original_fqdn = self.fqdn
         self.__original_secret = self.secret
+        self.__reset_original_ips()
+
+    def __reset_original_ips(self) -> None:
         try:
             self.__original_ipv4 = IPv4Address(str(self.ipv4))
         except AddressValueError:
@@ -62,45 +78,116 @@ class Host(models.Model):
         except AddressValueError:
             self.__original_ipv6 = None
 
-    def save(self, now=timezone.now(), *args, **kwargs):
-        if self.secret != self.__original_secret:
-            self.generate_secret(secret=self.secret, save=False)
-
-        ip_changed = False
+    def __update_changes(self, now) -> List[Tuple[int, str]]:
+        """
+        :return: the changed (family, ip)
+        """
+        changes = []
         if self.ipv4 != "" and self.ipv4 is not None and IPv4Address(self.ipv4) != self.__original_ipv4:
             self.last_ipv4_change = now
-            ip_changed = True
+            changes.append((UpdateTask.IPV4, self.ipv4))
         if self.ipv6 != "" and self.ipv6 is not None and IPv6Address(self.ipv6) != self.__original_ipv6:
             self.last_ipv6_change = now
-            ip_changed = True
+            changes.append((UpdateTask.IPV6, self.ipv6))
+        return changes
 
-        super(Host, self).save(*args, **kwargs)
+    def save(self, now=None, *args, propagate=True, **kwargs):
+        """
+        :param propagate: whether to refresh the records and queue their pushes, else call Record.propagate later,
+            e.g. once for many hosts
+        """
+        now = now or timezone.now()
 
+        if self.secret != self.__original_secret:
+            self.generate_secret(secret=self.secret, save=False)
+
+        changes = self.__update_changes(now)
+
+        with metrics.PHASE_SECONDS.time('save'):
+            super(Host, self).save(*args, **kwargs)
+
+        for family, ip in changes:
+            history.record(UpdateEvent.ip_change(self, family, ip, now))
+
+        self.__original_fqdn = self.fqdn
         self.__original_secret = self.secret
-        try:
-            self.__original_ipv4 = IPv4Address(str(self.ipv4))
-        except AddressValueError:
-            self.__original_ipv4 = None
-        try:
-            self.__original_ipv6 = IPv6Address(str(self.ipv6))
-        except AddressValueError:
-            self.__original_ipv6 = None
+        self.__reset_original_ips()
+
+        if propagate:
+            with metrics.PHASE_SECONDS.time('propagate'):
+                Record.propagate([self], now=now)
+
+        return bool(changes)
+
+    @classmethod
+    def save_many(cls, hosts: List['Host'], now=None) -> List[bool]:
+        """
+        Save the addresses and timestamps (UPDATE_FIELDS) of many existing hosts in bulk and propagate them to
+        their records. Other changed fields, e.g. the secret, are not saved.
+        :return: whether the ip changed, for every host
+        """
+        now = now or timezone.now()
+
+        changes = [host.__update_changes(now) for host in hosts]
+
+        with metrics.PHASE_SECONDS.time('save'):
+            cls.objects.bulk_update(hosts, cls.UPDATE_FIELDS, batch_size=500)
+
+        for host, host_changes in zip(hosts, changes):
+            for family, ip in host_changes:
+                history.record(UpdateEvent.ip_change(host, family, ip, now))
+            host.__reset_original_ips()
+            host.invalidate_cache()
 
-        for record in Record.objects.filter(host=self):
-            record.save(now=now)
+        with metrics.PHASE_SECONDS.time('propagate'):
+            Record.propagate(hosts, now=now)
 
-        return ip_changed
+        return [bool(host_changes) for host_changes in changes]
 
     def generate_secret(self, secret=None, save=True):
         if secret is None:
             secret = get_user_model().objects.make_random_password()
-        self.secret = make_password(secret)
+        self.secret = auth.make_secret(secret)
+        self.__original_secret = self.secret
+        auth.invalidate(self.fqdn)
         if save:
             self.save()
         return secret
 
-    def check_password(self, password):
-        return check_password(password, self.secret)
+    def check_password(self, password, setter=None):
+        """
+        :param setter: called with a new hash of the secret instead of storing it, e.g. to store it in another thread
+        """
+        return auth.check_secret(self.fqdn, password, self.secret, setter=setter or self.upgrade_secret)
+
+    def upgrade_secret(self, encoded):
+        """
+        Store a new hash of the unchanged secret, without saving or propagating the other fields.
+        """
+        self.secret = encoded
+        self.__original_secret = encoded
+        Host.objects.filter(pk=self.pk).update(secret=encoded)
+        self.invalidate_cache()
+
+    @classmethod
+    def get_cached(cls, fqdn: str) -> 'Host':
+        """
+        Get a host from the host cache or the database.
+        Cached hosts come with their records and their update services, without the host cache they are loaded by
+        Record.propagate only if the address changed.
+        :raise Host.DoesNotExist: if there is no host with the FQDN
+        """
+        if not hostcache.enabled():
+            return cls.objects.get(fqdn=fqdn)
+        host = hostcache.get(fqdn)
+        if host is None:
+            host = cls.objects.prefetch_related(
+                models.Prefetch('record_set', queryset=Record.objects.select_related('service'))).get(fqdn=fqdn)
+            hostcache.set(fqdn, host)
+        return host
+
+    def invalidate_cache(self) -> None:
+        hostcache.delete(*{self.fqdn, self.__original_fqdn} - {None})
 
 
 class UpdateService(models.Model):
@@ -117,12 +204,62 @@ class UpdateService(models.Model):
         default=False,
         help_text="Whether the HTTP Basic Auth username is the record FQDN.")
 
+    concurrency = models.PositiveSmallIntegerField(
+        default=4,
+        validators=[MinValueValidator(1)],
+        help_text="Maximum number of parallel update requests to this service.")
+
+    pool_size = models.PositiveSmallIntegerField(
+        default=10,
+        validators=[MinValueValidator(1)],
+        help_text="Maximum number of kept-alive connections to this service.")
+
+    timeout = models.PositiveSmallIntegerField(
+        default=30,
+        validators=[MinValueValidator(1)],
+        help_text="Timeout of update requests in seconds.")
+
+    max_hostnames = models.PositiveSmallIntegerField(
+        verbose_name="max. hostnames",
+        default=1,
+        validators=[MinValueValidator(1)],
+        help_text="Maximum number of comma-separated hostnames per update request. "
+                  "Set to 1 if the service does not support multiple hostnames.")
+
+    rate_limit = models.PositiveIntegerField(
+        default=0,
+        help_text="Maximum number of update requests per minute. Set to 0 for no limit.")
+
     def __str__(self):
         return self.name
 
     class Meta(object):
         ordering = ('name',)
 
+    @classmethod
+    def cached_all(cls) -> List['UpdateService']:
+        """
+        All update services, for the admin forms that list them. Cached, see ddnsbroker.hostcache.
+        """
+        services = hostcache.service_cache.get('all')
+        if services is None:
+            services = list(cls.objects.all())
+            hostcache.service_cache.set('all', services)
+        return services
+
+    def invalidate_cache(self) -> None:
+        hostcache.service_cache.clear()
+        hostcache.delete(*Host.objects.filter(record__service=self).values_list('fqdn', flat=True).distinct())
+
+
+def _needing_push(family: str) -> models.Q:
+    """
+    Records with an effective address of the family (ipv4 or ipv6) that changed after its last successful push.
+    """
+    return models.Q(**{'effective_{}__isnull'.format(family): False}) & (
+        models.Q(**{'last_{}_update__isnull'.format(family): True}) |
+        models.Q(**{'last_{}_change__gt'.format(family): models.F('last_{}_update'.format(family))}))
+
 
 class Record(models.Model):
     host = models.ForeignKey(Host, on_delete=models.PROTECT)
@@ -174,11 +311,16 @@ class Record(models.Model):
     __original_effective_ipv4 = None
     __original_effective_ipv6 = None
 
-    service = models.ForeignKey(UpdateService, on_delete=models.PROTECT)
+    # indexed by (service, host, fqdn)
+    service = models.ForeignKey(UpdateService, on_delete=models.PROTECT, db_index=False)
 
     username = models.CharField(max_length=255, blank=True)
     password = models.CharField(max_length=255)
 
+    update_error = models.CharField(
+        max_length=16, blank=True, editable=False,
+        help_text="Error code of the update service, no updates are sent until the record is saved again.")
+
     last_ipv4_update = models.DateTimeField(null=True, blank=True, editable=False)
     last_ipv6_update = models.DateTimeField(null=True, blank=True, editable=False)
     last_ipv4_change = models.DateTimeField(null=True, blank=True, editable=False)
@@ -192,99 +334,459 @@ class Record(models.Model):
     class Meta(object):
         unique_together = (('host', 'fqdn'),)
         ordering = ('host', 'fqdn')
+        indexes = [
+            models.Index(fields=['service', 'host', 'fqdn'], name='ddnsbroker_record_service'),
+            # partial indexes, so finding the records that need a push does not scan all records
+            models.Index(fields=['id'], condition=_needing_push('ipv4'), name='ddnsbroker_record_ipv4_push'),
+            models.Index(fields=['id'], condition=_needing_push('ipv6'), name='ddnsbroker_record_ipv6_push'),
+        ]
+
+    REFRESH_FIELDS = ('fqdn', 'username', 'effective_ipv4', 'effective_ipv6', 'last_ipv4_change', 'last_ipv6_change')
+    # written by propagate, the other fields are edited by admins and must not be overwritten from a cached record
+    PROPAGATE_FIELDS = ('effective_ipv4', 'effective_ipv6', 'last_ipv4_change', 'last_ipv6_change')
+    # derived from host and service by refresh, written by propagate only if they changed
+    NAME_FIELDS = ('fqdn', 'username')
 
     def __init__(self, *args, **kwargs):
         super(Record, self).__init__(*args, **kwargs)
+        self.__original_host_id = self.host_id
+        self.__original_effective_ipv4 = self.effective_ipv4
+        self.__original_effective_ipv6 = self.effective_ipv6
+
+    def save(self, now=None, *args, **kwargs):
+        now = now or timezone.now()
+
+        self.refresh(now=now)
+
+        # saving the record is how an admin acknowledges an update error
+        self.update_error = ""
+
+        super(Record, self).save(*args, **kwargs)
+
+        self.__original_host_id = self.host_id
         self.__original_effective_ipv4 = self.effective_ipv4
         self.__original_effective_ipv6 = self.effective_ipv6
 
-    def save(self, now=timezone.now(), *args, **kwargs):
+        UpdateTask.enqueue_many(self.pending_updates())
+
+    def refresh(self, now=None, effective: Optional[Tuple[Optional[str], Optional[str]]] = None) -> bool:
+        """
+        Recompute the derived fields from host and service without saving.
+        :param effective: the effective (ipv4, ipv6), if already computed for many records of the host at once
+        :return: whether one of REFRESH_FIELDS changed
+        """
+        now = now or timezone.now()
+
+        before = [getattr(self, field) for field in self.REFRESH_FIELDS]
+
         if not self.fqdn:
             self.fqdn = self.host.fqdn
         if self.service.username_is_fqdn:
             self.username = self.fqdn
 
-        self.__update_effective_ipv4()
-        self.__update_effective_ipv6()
+        if effective is None:
+            self.__update_effective_ipv4()
+            self.__update_effective_ipv6()
+        else:
+            self.effective_ipv4, self.effective_ipv6 = effective
 
         if self.effective_ipv4 != self.__original_effective_ipv4:
             self.last_ipv4_change = now
         if self.effective_ipv6 != self.__original_effective_ipv6:
             self.last_ipv6_change = now
 
+        return before != [getattr(self, field) for field in self.REFRESH_FIELDS]
+
+    def invalidate_cache(self) -> None:
+        host_ids = {self.host_id, self.__original_host_id} - {None}
+        hostcache.delete(*Host.objects.filter(pk__in=host_ids).values_list('fqdn', flat=True))
+
+    @classmethod
+    def needing_push(cls, family: int) -> models.QuerySet:
+        """
+        Records whose effective address of the family changed after its last successful push, including records with
+        an update error or a queued push. Ordered by pk, so the partial index is read in order.
+        """
+        return cls.objects.filter(_needing_push('ipv4' if family == UpdateTask.IPV4 else 'ipv6')).order_by('pk')
+
+    def pending_updates(self) -> List[Tuple['Record', int, str]]:
+        """
+        The pushes this record needs, as arguments for UpdateTask.enqueue_many.
+        Pushes are done by the dispatchupdates worker, see ddnsbroker.dispatch.
+        """
+        pending = []
+        if self.update_error:
+            return pending
         if self.ipv4_enabled and self.effective_ipv4 is not None and \
                 (self.last_ipv4_update is None or self.last_ipv4_change > self.last_ipv4_update):
-            self.dyndns2_update_ipv4(now=now)
+            pending.append((self, UpdateTask.IPV4, self.effective_ipv4))
         if self.ipv6_enabled and self.effective_ipv6 is not None and \
                 (self.last_ipv6_update is None or self.last_ipv6_change > self.last_ipv6_update):
-            self.dyndns2_update_ipv6(now=now)
+            pending.append((self, UpdateTask.IPV6, self.effective_ipv6))
+        return pending
+
+    @classmethod
+    def propagate(cls, hosts: List[Host], now=None, queue: bool = True) -> None:
+        """
+        Refresh all records of the hosts, save their changed addresses (PROPAGATE_FIELDS) and names (NAME_FIELDS) and
+        queue their pushes.
+        Uses the same number of queries regardless of the number of records.
+        :param queue: whether to queue the pushes, else they are found by Record.needing_push
+        """
+        now = now or timezone.now()
+
+        hosts = {host.pk: host for host in hosts}
+        if not hosts:
+            return
 
-        super(Record, self).save(*args, **kwargs)
+        # records prefetched by Host.get_cached are used as they are
+        records, missing = [], []
+        for pk, host in hosts.items():
+            prefetched = getattr(host, '_prefetched_objects_cache', {}).get('record_set')
+            if prefetched is None:
+                missing.append(pk)
+            else:
+                records += prefetched
+        if missing:
+            records += cls.objects.filter(host__in=missing).select_related('service')
+
+        by_host: Dict[int, List[Record]] = {}
+        for record in records:
+            by_host.setdefault(record.host_id, []).append(record)
+
+        # the effective addresses of the records of a host share the parsed host address
+        changed, renamed = [], []
+        for pk, host_records in by_host.items():
+            host = hosts[pk]
+            ipv4s = effective_ipv4_many(host.ipv4, [(record.ipv4_netmask, record.ipv4_host_id)
+                                                    for record in host_records])
+            ipv6s = effective_ipv6_many(host.ipv6, [(record.ipv6_netmask, record.ipv6_host_id)
+                                                    for record in host_records])
+            for record, ipv4, ipv6 in zip(host_records, ipv4s, ipv6s):
+                record.host = host
+                names = [getattr(record, field) for field in cls.NAME_FIELDS]
+                if record.refresh(now=now, effective=(ipv4, ipv6)):
+                    changed.append(record)
+                if names != [getattr(record, field) for field in cls.NAME_FIELDS]:
+                    renamed.append(record)
+
+        if not changed:
+            return
 
-        self.__original_effective_ipv4 = self.effective_ipv4
-        self.__original_effective_ipv6 = self.effective_ipv6
+        cls.objects.bulk_update(changed, cls.PROPAGATE_FIELDS, batch_size=500)
+        if renamed:
+            cls.objects.bulk_update(renamed, cls.NAME_FIELDS, batch_size=500)
+
+        pending = []
+        for record in changed:
+            record.__original_effective_ipv4 = record.effective_ipv4
+            record.__original_effective_ipv6 = record.effective_ipv6
+            pending += record.pending_updates()
+        if queue:
+            UpdateTask.enqueue_many(pending)
 
     def __update_effective_ipv4(self) -> None:
-        if self.host.ipv4 is None or self.host.ipv4 == "":
-            self.effective_ipv4 = None
-            return
+        self.effective_ipv4 = effective_ipv4(self.host.ipv4, self.ipv4_netmask, self.ipv4_host_id)
 
-        host_id: int = int(IPv4Address(self.ipv4_host_id))
-        host_id_short: int = host_id & ((1 << 32 - self.ipv4_netmask) - 1)
+    def __update_effective_ipv6(self) -> None:
+        self.effective_ipv6 = effective_ipv6(self.host.ipv6, self.ipv6_netmask, self.ipv6_host_id)
 
-        network: str = "{}/{}".format(self.host.ipv4, self.ipv4_netmask)
-        network_address: IPv4Address = IPv4Network(network, strict=False).network_address
+    def dyndns2_update(self, ip: str) -> bool:
+        reply, = dyndns2.update(self.service, self.username, self.password, [self.fqdn], ip)
+        return dyndns2.is_success(reply)
 
-        self.effective_ipv4 = str(network_address + host_id_short)
+    def dyndns2_update_ipv4(self, now=None) -> bool:
+        now = now or timezone.now()
 
-    def __update_effective_ipv6(self) -> None:
-        if self.host.ipv6 is None or self.host.ipv6 == "":
-            self.effective_ipv6 = None
-            return
+        success = self.dyndns2_update(self.effective_ipv4)
+        if success:
+            self.last_ipv4_update = now
+        return success
 
-        host_id: int = int(IPv6Address(self.ipv6_host_id))
-        host_id_short: int = host_id & ((1 << 128 - self.ipv6_netmask) - 1)
+    def dyndns2_update_ipv6(self, now=None) -> bool:
+        now = now or timezone.now()
 
-        network: str = "{}/{}".format(self.host.ipv6, self.ipv6_netmask)
-        network_address: IPv6Address = IPv6Network(network, strict=False).network_address
+        success = self.dyndns2_update(self.effective_ipv6)
+        if success:
+            self.last_ipv6_update = now
+        return success
 
-        self.effective_ipv6 = str(network_address + host_id_short)
 
-    def __dyndns2_update(self, ip: str) -> bool:
-        params = {
-            'hostname': self.fqdn,
-            'myip': ip
-        }
-        auth = (self.username, self.password)
+class UpdateTask(models.Model):
+    """
+    A pending dyndns2 push of a record, drained by the dispatchupdates command.
 
-        logger.debug("update request: {} {}".format(self.service.url, params))
+    There is at most one task per record and address family, a newer address replaces the queued one.
+    """
+    IPV4 = 4
+    IPV6 = 6
+    FAMILY_CHOICES = (
+        (IPV4, "IPv4"),
+        (IPV6, "IPv6"),
+    )
 
-        try:
-            r = requests.get(self.service.url, params=params, auth=auth, timeout=30)
-            r.close()
+    record = models.ForeignKey(Record, on_delete=models.CASCADE)
+    family = models.PositiveSmallIntegerField(choices=FAMILY_CHOICES)
+    ip = models.GenericIPAddressField(verbose_name="IP")
+
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+    not_before = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
+
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    job = models.ForeignKey('UpdateJob', on_delete=models.SET_NULL, null=True, blank=True, editable=False)
+
+    def __str__(self):
+        return "{} {}".format(self.record, self.ip)
 
-            text = r.text.strip()
-            code = r.status_code
+    class Meta(object):
+        unique_together = (('record', 'family'),)
+        ordering = ('attempts', 'created')
+
+    @classmethod
+    def enqueue_many(cls, pending: List[Tuple[Record, int, str]]) -> None:
+        """
+        Queue pushes of (record, family, ip), replacing the ip of already queued tasks.
+        New pushes are due after the debounce time of the host of the record. A queued push that has not been tried
+        yet keeps its due time, so all changes within the debounce time are pushed as one.
+        The queued tasks are locked, so the worker cannot delete a task that is being replaced, and a task queued by
+        a concurrent request in the meantime gets the ip of this call, the later one.
+        """
+        if not pending:
+            return
+
+        now = timezone.now()
+        collapsed = 0
+        with transaction.atomic():
+            existing = {
+                (task.record_id, task.family): task
+                for task in cls.objects.select_for_update().filter(
+                    record__in={record.pk for record, family, ip in pending})
+            }
+
+            updated, created = [], []
+            for record, family, ip in pending:
+                task = existing.get((record.pk, family))
+                due = now + timedelta(seconds=record.host.debounce)
+                if task is None:
+                    created.append(cls(record=record, family=family, ip=ip, not_before=due))
+                else:
+                    # a queued address that was never pushed is replaced
+                    never_pushed = task.attempts == 0
+                    if cls.__replace_ip(task, ip, due):
+                        collapsed += never_pushed
+                        updated.append(task)
+                logger.debug("queued update: {} {}".format(record.fqdn, ip))
+
+            if created:
+                cls.objects.bulk_create(created, batch_size=500, ignore_conflicts=True)
+                # a concurrent request may have queued the same record in the meantime
+                wanted = {(task.record_id, task.family): task for task in created}
+                for task in cls.objects.select_for_update().filter(record__in={pk for pk, family in wanted}):
+                    new = wanted.get((task.record_id, task.family))
+                    if new is not None and cls.__replace_ip(task, new.ip, new.not_before):
+                        updated.append(task)
+            if updated:
+                cls.objects.bulk_update(updated, ['ip', 'attempts', 'not_before'], batch_size=500)
+
+        if collapsed:
+            metrics.PUSHES_COLLAPSED.inc(amount=collapsed)
+
+    @staticmethod
+    def __replace_ip(task: 'UpdateTask', ip: str, due) -> bool:
+        """
+        Set a new ip on a queued task.
+        :return: whether the task changed
+        """
+        if task.ip == ip:
+            return False
+        if task.attempts > 0:
+            # a new address is not retried, the same address keeps its retry schedule
+            task.attempts = 0
+            task.not_before = due
+        # else the queued address was never pushed, the task keeps its due time
+        task.ip = ip
+        return True
+
+    @classmethod
+    def force_many(cls, pending: List[Tuple[Record, int, str]], job: 'UpdateJob') -> None:
+        """
+        Queue pushes of (record, family, ip) that are due right away, also if the address was pushed already or
+        the queued push waits for a retry.
+        """
+        if not pending:
+            return
+
+        now = timezone.now()
+        existing = {
+            (task.record_id, task.family): task
+            for task in cls.objects.filter(record__in={record.pk for record, family, ip in pending})
+        }
 
-            if code == 200 and (text.startswith("good") or text.startswith("nochg")):
-                logger.info("update response success: {} {} -> {}".format(self.service.url, params, text))
-                return True
+        updated, created = [], []
+        for record, family, ip in pending:
+            task = existing.get((record.pk, family))
+            if task is None:
+                created.append(cls(record=record, family=family, ip=ip, not_before=now, job=job))
             else:
-                logger.error("update response error: {} {} -> {} {}".format(self.service.url, params, code, text))
-        except ConnectionError:
-            logger.error("update connection error: {} {}".format(self.service.url, params))
-            pass
+                task.ip = ip
+                task.attempts = 0
+                task.not_before = now
+                task.job = job
+                updated.append(task)
 
-        return False
+        if updated:
+            cls.objects.bulk_update(updated, ['ip', 'attempts', 'not_before', 'job'], batch_size=500)
+        if created:
+            cls.objects.bulk_create(created, batch_size=500, ignore_conflicts=True)
 
-    def dyndns2_update_ipv4(self, now=timezone.now()) -> bool:
-        success = self.__dyndns2_update(self.effective_ipv4)
-        if success:
-            self.last_ipv4_update = now
-        return success
 
-    def dyndns2_update_ipv6(self, now=timezone.now()) -> bool:
-        success = self.__dyndns2_update(self.effective_ipv6)
-        if success:
-            self.last_ipv6_update = now
-        return success
+class UpdateJob(models.Model):
+    """
+    A forced push of records, started with the "Force update selected records" admin action.
+
+    The pushes are queued as UpdateTasks and done by the dispatchupdates worker, which writes the result of every
+    push to the UpdateJobItems of the job.
+    """
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    def __str__(self):
+        return "Update job {}".format(self.pk)
+
+    class Meta(object):
+        ordering = ('-created',)
+
+    @classmethod
+    def start(cls, records) -> 'UpdateJob':
+        """
+        Create a job for the effective addresses of the records and queue their pushes.
+        Records with an update error are not pushed, their error is the result.
+        """
+        now = timezone.now()
+        job = cls.objects.create(created=now)
+
+        items, pending = [], []
+        for record in records:
+            for family, name in ((UpdateTask.IPV4, 'ipv4'), (UpdateTask.IPV6, 'ipv6')):
+                ip = getattr(record, 'effective_' + name)
+                if not getattr(record, name + '_enabled') or ip is None:
+                    continue
+                item = UpdateJobItem(job=job, record=record, family=family, ip=ip)
+                if record.update_error:
+                    item.result = record.update_error
+                    item.finished = now
+                else:
+                    pending.append((record, family, ip))
+                items.append(item)
+
+        UpdateJobItem.objects.bulk_create(items, batch_size=500)
+        UpdateTask.force_many(pending, job)
+        return job
+
+    def progress(self) -> Dict[str, int]:
+        counts = self.items.aggregate(total=models.Count('pk'), finished=models.Count('finished'),
+                                      succeeded=models.Count('pk', filter=models.Q(result__in=('good', 'nochg'))))
+        counts['failed'] = counts['finished'] - counts['succeeded']
+        return counts
+
+
+class UpdateJobItem(models.Model):
+    """
+    The push of one address of a record in an UpdateJob.
+    """
+    job = models.ForeignKey(UpdateJob, on_delete=models.CASCADE, related_name='items')
+    record = models.ForeignKey(Record, on_delete=models.CASCADE)
+    family = models.PositiveSmallIntegerField(choices=UpdateTask.FAMILY_CHOICES)
+    ip = models.GenericIPAddressField(verbose_name="IP")
+
+    result = models.CharField(
+        max_length=16, blank=True,
+        help_text="Reply code of the last try, 'error' if there was no usable reply.")
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "{} {}".format(self.record, self.ip)
+
+    class Meta(object):
+        unique_together = (('job', 'record', 'family'),)
+        ordering = ('job', 'record', 'family')
+
+    @classmethod
+    def record_results(cls, results: List[Tuple[UpdateTask, str, bool]], now=None, chunk_size: int = 500) -> None:
+        """
+        Write the (task, result, finished) of pushes to the items of their jobs, with one query per chunk of tasks
+        and distinct result.
+        """
+        now = now or timezone.now()
+
+        results = [(task, result, finished) for task, result, finished in results if task.job_id is not None]
+        for start in range(0, len(results), chunk_size):
+            chunk = {(task.job_id, task.record_id, task.family): (result, finished)
+                     for task, result, finished in results[start:start + chunk_size]}
+            items = cls.objects.filter(job__in={job for job, record, family in chunk},
+                                       record__in={record for job, record, family in chunk})
+
+            grouped: Dict[Tuple[str, bool], List[int]] = {}
+            for pk, job, record, family in items.values_list('pk', 'job_id', 'record_id', 'family'):
+                if (job, record, family) in chunk:
+                    grouped.setdefault(chunk[(job, record, family)], []).append(pk)
+
+            for (result, finished), pks in grouped.items():
+                cls.objects.filter(pk__in=pks).update(result=result, finished=now if finished else None)
+
+
+class UpdateEvent(models.Model):
+    """
+    The append-only history of address changes of hosts and pushes of records, written in batches by
+    ddnsbroker.history. Addresses are stored packed, results as small integers, and the foreign keys have no
+    constraints, so events of deleted hosts and records stay until they are pruned.
+    """
+    IP_CHANGE = 1
+    PUSH = 2
+    KIND_CHOICES = (
+        (IP_CHANGE, "address change"),
+        (PUSH, "push"),
+    )
+
+    RESULTS = ('good', 'nochg', 'error', 'disabled', 'badauth', 'notfqdn', 'nohost', 'numhost', 'abuse', '!yours',
+               '!donator', '911', 'dnserr', 'badagent')
+    RESULT_CHOICES = tuple((value, code) for value, code in enumerate(RESULTS, 1))
+
+    id = models.BigAutoField(primary_key=True)
+    time = models.DateTimeField(db_index=True)
+    # indexed by (host, time)
+    host = models.ForeignKey(Host, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+                             related_name='+')
+    record = models.ForeignKey(Record, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, null=True,
+                               blank=True, related_name='+')
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    family = models.PositiveSmallIntegerField(choices=UpdateTask.FAMILY_CHOICES)
+    address = models.BinaryField(max_length=16)
+    result = models.PositiveSmallIntegerField(choices=RESULT_CHOICES, null=True, blank=True)
+
+    def __str__(self):
+        return "{} {} {}".format(self.record or self.host, self.get_kind_display(), self.ip)
+
+    class Meta(object):
+        indexes = [models.Index(fields=['host', 'time'], name='ddnsbroker_event_host_time')]
+
+    @property
+    def ip(self) -> str:
+        return str(ip_address(bytes(self.address)))
+
+    @classmethod
+    def ip_change(cls, host: Host, family: int, ip: str, now) -> 'UpdateEvent':
+        return cls(time=now, host_id=host.pk, kind=cls.IP_CHANGE, family=family, address=ip_address(ip).packed)
+
+    @classmethod
+    def push(cls, task: UpdateTask, code: str, now) -> 'UpdateEvent':
+        result = cls.RESULTS.index(code) + 1 if code in cls.RESULTS else cls.RESULTS.index('error') + 1
+        return cls(time=now, host_id=task.record.host_id, record_id=task.record_id, kind=cls.PUSH,
+                   family=task.family, address=ip_address(task.ip).packed, result=result)
+
+
+@receiver((post_save, post_delete), sender=Host)
+@receiver((post_save, post_delete), sender=Record)
+@receiver((post_save, post_delete), sender=UpdateService)
+def invalidate_host_cache(sender, instance, **kwargs):
+    instance.invalidate_cache()
@@ -0,0 +1,77 @@
+"""
+Reconciliation of the published DNS records with the effective addresses, run by the reconcile command.
+
+A successful push only means the update service answered "good". The records are resolved in batches, and a push
+is queued only for the records that resolve to something else than their effective address. Records with a queued
+push or an update error are skipped, and records that could not be resolved are reported but not pushed.
+"""
+
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ddnsbroker.models import Record, UpdateTask
+from ddnsbroker.tools.resolver import A, AAAA, Resolver, ResolverError
+
+logger = logging.getLogger(__name__)
+
+FAMILIES = ((UpdateTask.IPV4, A, 'ipv4'), (UpdateTask.IPV6, AAAA, 'ipv6'))
+
+
+def _checks(records: List[Record], queued: set) -> List[Tuple[Record, int, int, str]]:
+    """
+    :return: (record, family, rdtype, effective ip) for every enabled family with an effective address
+    """
+    checks = []
+    for record in records:
+        for family, rdtype, name in FAMILIES:
+            ip = getattr(record, 'effective_' + name)
+            if getattr(record, name + '_enabled') and ip is not None and (record.pk, family) not in queued:
+                checks.append((record, family, rdtype, ip))
+    return checks
+
+
+def reconcile(resolver: Resolver, batch_size: int = 500, concurrency: int = 50, dry_run: bool = False,
+              progress: Optional[Callable[[Dict[str, int]], None]] = None) -> Dict[str, int]:
+    """
+    Resolve all records and queue pushes of the ones that differ.
+    :param progress: called with the counts after every batch
+    :return: counts of checked, matching, differing and failed lookups and of queued pushes
+    """
+    stats = {'records': Record.objects.count(), 'checked': 0, 'matching': 0, 'differing': 0, 'failed': 0,
+             'queued': 0}
+
+    records = Record.objects.filter(update_error="").select_related('host').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(records.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        queued = set(UpdateTask.objects.filter(record__in=batch).values_list('record_id', 'family'))
+        checks = _checks(batch, queued)
+        results = asyncio.run(resolver.resolve_many(
+            [(record.fqdn, rdtype) for record, family, rdtype, ip in checks], concurrency=concurrency))
+
+        pending = []
+        for (record, family, rdtype, ip), published in zip(checks, results):
+            stats['checked'] += 1
+            if isinstance(published, ResolverError):
+                logger.warning("lookup failed: {}".format(published))
+                stats['failed'] += 1
+            elif published == [ip]:
+                stats['matching'] += 1
+            else:
+                logger.info("{} resolves to {} instead of {}".format(record.fqdn, published, ip))
+                stats['differing'] += 1
+                pending.append((record, family, ip))
+
+        if pending and not dry_run:
+            UpdateTask.enqueue_many(pending)
+            stats['queued'] += len(pending)
+
+        if progress is not None:
+            progress(stats)
+
+    return stats
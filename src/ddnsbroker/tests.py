@@ -0,0 +1,285 @@
+import socketserver
+import struct
+import threading
+from base64 import b64encode
+from io import StringIO
+from ipaddress import ip_address
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from ddnsbroker import audit, auth, dispatch, history, lastseen
+from ddnsbroker.models import Host, Record, UpdateService, UpdateTask
+from ddnsbroker.tools import resolver
+from ddnsbroker.tools.buffer import WriteBuffer
+from ddnsbroker.views import AsyncNicUpdateView
+
+
+class StubNameServer(object):
+    """
+    A local UDP name server that answers from `answers`, a dict of (name, rdtype) to a list of addresses, to
+    resolver.NXDOMAIN, or to None for no reply at all. Other names get an empty answer.
+    """
+
+    def __init__(self, answers):
+        class StubHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                query, sock = self.request
+                query_id, = struct.unpack_from('!H', query)
+                end = query.index(b'\x00', 12) + 1
+                name, offset = [], 12
+                while query[offset]:
+                    name.append(query[offset + 1:offset + 1 + query[offset]].decode('ascii'))
+                    offset += 1 + query[offset]
+                rdtype, = struct.unpack_from('!H', query, end)
+                answer = answers.get(('.'.join(name), rdtype), [])
+                if answer is None:
+                    return
+                rcode = resolver.NXDOMAIN if answer == resolver.NXDOMAIN else resolver.NOERROR
+                addresses = [] if rcode else answer
+                response = struct.pack('!HHHHHH', query_id, 0x8180 | rcode, 1, len(addresses), 0, 0)
+                response += query[12:end + 4]
+                for address in addresses:
+                    rdata = ip_address(address).packed
+                    response += struct.pack('!HHHIH', 0xc00c, rdtype, resolver.CLASS_IN, 60, len(rdata)) + rdata
+                sock.sendto(response, self.client_address)
+
+        self.server = socketserver.ThreadingUDPServer(('127.0.0.1', 0), StubHandler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class HostTestCase(TestCase):
+    def setUp(self):
+        self.service = UpdateService.objects.create(name='test', url='https://dyndns.example.com/nic/update')
+        # else the buffered writes are written at exit, after the test database is gone
+        self.addCleanup(history.events.flush)
+        self.addCleanup(lastseen.last_seen.flush)
+
+    def create_host(self, fqdn: str, records: int) -> Host:
+        host = Host(fqdn=fqdn, secret='S3CRET', ipv4='192.0.2.1')
+        host.save()
+        Record.objects.bulk_create([
+            Record(host=host, fqdn='r{}.{}'.format(i, fqdn), service=self.service, password='pw', ipv4_netmask=24,
+                   ipv4_host_id='0.0.0.{}'.format(i % 256))
+            for i in range(records)])
+        return Host.objects.get(pk=host.pk)
+
+
+class PropagateTest(HostTestCase):
+    def test_constant_queries(self):
+        # both below the batch size of the bulk writes on SQLite
+        few, many = self.create_host('few.example.com', 10), self.create_host('many.example.com', 100)
+        few.ipv4 = many.ipv4 = '198.51.100.1'
+
+        # the buffered history is written every few seconds, not during the measured saves
+        history.events.flush()
+        with CaptureQueriesContext(connection) as queries:
+            few.save()
+        with self.assertNumQueries(len(queries)):
+            many.save()
+
+        self.assertEqual(UpdateTask.objects.filter(record__host=many).count(), 100)
+        self.assertEqual(set(Record.objects.filter(host=many).values_list('effective_ipv4', flat=True)),
+                         {'198.51.100.{}'.format(i) for i in range(100)})
+
+    def test_enqueue_replaces_ip(self):
+        host = self.create_host('queued.example.com', 3)
+        records = list(host.record_set.select_related('host'))
+        UpdateTask.objects.filter(record__host=host).update(attempts=2)
+
+        UpdateTask.enqueue_many([(record, UpdateTask.IPV4, '198.51.100.7') for record in records])
+        tasks = UpdateTask.objects.filter(record__host=host, family=UpdateTask.IPV4)
+        self.assertEqual(set(tasks.values_list('ip', 'attempts')), {('198.51.100.7', 0)})
+
+        # a task dropped by the worker in the meantime is queued again
+        tasks.filter(record=records[0]).delete()
+        UpdateTask.enqueue_many([(record, UpdateTask.IPV4, '198.51.100.8') for record in records])
+        self.assertEqual(list(tasks.values_list('ip', flat=True)), ['198.51.100.8'] * 3)
+
+    def test_propagate_saves_names(self):
+        host = self.create_host('renamed.example.com', 2)
+        UpdateService.objects.filter(pk=self.service.pk).update(username_is_fqdn=True)
+
+        host = Host.objects.get(pk=host.pk)
+        host.ipv4 = '198.51.100.1'
+        host.save()
+
+        self.assertEqual(set(Record.objects.filter(host=host).values_list('username', flat=True)),
+                         {'r0.renamed.example.com', 'r1.renamed.example.com'})
+
+
+class AsyncNicUpdateTest(HostTestCase):
+    @override_settings(DDNSBROKER_SECRET_HASHER=auth.HostSecretHasher.algorithm)
+    def test_upgrades_secret(self):
+        host = self.create_host('async.example.com', 1)
+        Host.objects.filter(pk=host.pk).update(secret=make_password('S3CRET'))
+
+        credentials = b64encode(b'async.example.com:S3CRET').decode('ascii')
+        request = RequestFactory().get('/nic/update', {'myip': '192.0.2.1'}, HTTP_AUTHORIZATION='Basic ' + credentials)
+        response = async_to_sync(AsyncNicUpdateView.as_view())(request)
+
+        self.assertEqual(response.content, b'nochg 192.0.2.1')
+        # written in the thread of the test, i.e. the ORM thread, and so visible in its transaction
+        self.assertTrue(Host.objects.get(pk=host.pk).secret.startswith(auth.HostSecretHasher.algorithm + '$'))
+
+
+class AdminQueriesTest(HostTestCase):
+    def setUp(self):
+        super(AdminQueriesTest, self).setUp()
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'pw'))
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertSameQueries(self, first_url, second_url):
+        # the first request fills the per-process caches, e.g. the update services of the record forms
+        self.get(first_url)
+        history.events.flush()
+        with CaptureQueriesContext(connection) as queries:
+            self.get(first_url)
+        with self.assertNumQueries(len(queries)):
+            self.get(second_url)
+
+    def test_changelists(self):
+        self.create_host('first.example.com', 2)
+        for model in ('host', 'record'):
+            url = reverse('admin:ddnsbroker_{}_changelist'.format(model))
+            self.get(url)
+            with CaptureQueriesContext(connection) as queries:
+                self.get(url)
+            for i in range(10):
+                self.create_host('h{}.{}.example.com'.format(i, model), 5)
+            history.events.flush()
+            with self.assertNumQueries(len(queries)):
+                self.get(url)
+
+    def test_change_pages(self):
+        few, many = self.create_host('few.example.com', 2), self.create_host('many.example.com', 40)
+        self.assertSameQueries(reverse('admin:ddnsbroker_host_change', args=[few.pk]),
+                               reverse('admin:ddnsbroker_host_change', args=[many.pk]))
+        self.assertSameQueries(reverse('admin:ddnsbroker_record_change', args=[few.record_set.first().pk]),
+                               reverse('admin:ddnsbroker_record_change', args=[many.record_set.first().pk]))
+
+    @override_settings(DDNSBROKER_ADMIN_INLINE_RECORDS=10)
+    def test_inline_cutoff(self):
+        few, many = self.create_host('few.example.com', 10), self.create_host('many.example.com', 11)
+        self.assertEqual(len(self.get(reverse('admin:ddnsbroker_host_change', args=[few.pk]))
+                             .context['inline_admin_formsets']), 1)
+        self.assertEqual(self.get(reverse('admin:ddnsbroker_host_change', args=[many.pk]))
+                         .context['inline_admin_formsets'], [])
+
+
+class ReconcileTest(HostTestCase):
+    def setUp(self):
+        super(ReconcileTest, self).setUp()
+        # saved again to compute the effective addresses of the records
+        self.create_host('dns.example.com', 5).save()
+        # r0 resolves to its effective address 192.0.2.0, r4 gets no reply
+        self.nameserver = StubNameServer({
+            ('r0.dns.example.com', resolver.A): ['192.0.2.0'],
+            ('r1.dns.example.com', resolver.A): ['198.51.100.1'],
+            ('r2.dns.example.com', resolver.A): resolver.NXDOMAIN,
+            ('r4.dns.example.com', resolver.A): None,
+        })
+        self.addCleanup(self.nameserver.close)
+        UpdateTask.objects.all().delete()
+
+    def reconcile(self, *args) -> str:
+        out = StringIO()
+        # r4 fails every time
+        with self.assertLogs('ddnsbroker.reconcile', 'INFO'):
+            call_command('reconcile', '--nameserver', '127.0.0.1', '--port', str(self.nameserver.port),
+                         '--timeout', '0.2', *args, stdout=out)
+        return out.getvalue().strip()
+
+    def test_queues_differing_records(self):
+        self.assertEqual(self.reconcile(), "5 lookups of 5 records: 1 matching, 3 differing, 1 failed, "
+                                           "3 pushes queued")
+        self.assertEqual(set(UpdateTask.objects.values_list('record__fqdn', 'family', 'ip')), {
+            ('r1.dns.example.com', UpdateTask.IPV4, '192.0.2.1'),
+            ('r2.dns.example.com', UpdateTask.IPV4, '192.0.2.2'),
+            ('r3.dns.example.com', UpdateTask.IPV4, '192.0.2.3'),
+        })
+
+        # records with a queued push are not resolved again
+        self.assertEqual(self.reconcile(), "2 lookups of 5 records: 1 matching, 0 differing, 1 failed, "
+                                           "0 pushes queued")
+
+    def test_dry_run(self):
+        self.assertEqual(self.reconcile('--dry-run'), "5 lookups of 5 records: 1 matching, 3 differing, "
+                                                      "1 failed, 0 pushes queued")
+        self.assertFalse(UpdateTask.objects.exists())
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        dispatch._queue_stats.clear()
+
+    def test_allowed_addresses(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1').status_code, 403)
+        with self.settings(DDNSBROKER_METRICS_ALLOWED=['203.0.113.0/24']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1').status_code, 200)
+
+    @override_settings(DDNSBROKER_METRICS_TOKEN='T0KEN')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1',
+                                         HTTP_AUTHORIZATION='Bearer T0KEN').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.1',
+                                         HTTP_AUTHORIZATION='Bearer WRONG').status_code, 403)
+
+    def test_queue_cached(self):
+        with self.assertNumQueries(1):
+            self.client.get('/metrics')
+        with self.assertNumQueries(0):
+            self.assertIn(b'ddnsbroker_queue_tasks{state="depth"} 0', self.client.get('/metrics').content)
+
+
+class AuditTest(TestCase):
+    def test_no_full_scans(self):
+        for name, plan, scans in audit.audit():
+            with self.subTest(name):
+                self.assertEqual(scans, [], plan)
+
+
+class WriteBufferTest(SimpleTestCase):
+    def test_flush_on_append_at_maxsize_only(self):
+        flushed = []
+        buffer = WriteBuffer(flushed.append, interval=3600, maxsize=3)
+        buffer.append(0)
+        # an elapsed interval is left to the background thread, which is asleep
+        buffer._WriteBuffer__last_flush -= 7200
+        buffer.append(1)
+        self.assertEqual(flushed, [])
+        buffer.append(2)
+        self.assertEqual(flushed, [[0, 1, 2]])
+
+    def test_failed_flush_keeps_items(self):
+        flushed = []
+
+        def flush(items):
+            if not flushed:
+                flushed.append(None)
+                raise RuntimeError("database is gone")
+            flushed.append(items)
+
+        buffer = WriteBuffer(flush, interval=3600, maxsize=2)
+        buffer.append(0)
+        with self.assertLogs('ddnsbroker.tools.buffer', 'ERROR'):
+            buffer.append(1)
+        self.assertEqual(len(buffer), 2)
+        buffer.append(2)
+        self.assertEqual(flushed, [None, [0, 1, 2]])
@@ -0,0 +1,80 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer(object):
+    """
+    Collects items in memory and passes them in batches to a flush function.
+
+    The buffer is flushed by a background thread at most `interval` seconds after the last flush, and at interpreter
+    exit. Only when `maxsize` items are pending, it is flushed on append, in the thread of the caller. An interval of 0
+    flushes every item immediately.
+    Items of a failed flush are kept for the next one.
+    """
+
+    def __init__(self, flush: Callable[[List[Any]], None], interval: float, maxsize: int = 10000):
+        self.interval = interval
+        self.maxsize = maxsize
+        self.__flush = flush
+        self.__items = []
+        self.__last_flush = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__timer: Optional[threading.Thread] = None
+        self.__timer_pid = None
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def append(self, item: Any) -> None:
+        with self.__lock:
+            self.__items.append(item)
+            due = not self.interval or len(self.__items) >= self.maxsize
+            self.__start_timer()
+        if due:
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing buffered writes failed")
+
+    def flush(self) -> None:
+        with self.__lock:
+            items, self.__items = self.__items, []
+            self.__last_flush = time.monotonic()
+        if not items:
+            return
+        try:
+            self.__flush(items)
+        except Exception:
+            with self.__lock:
+                self.__items[:0] = items
+            raise
+
+    def __start_timer(self) -> None:
+        # started on first use in every process, a thread started before a (pre)fork does not run in the workers
+        if self.interval and (self.__timer is None or self.__timer_pid != os.getpid()):
+            self.__timer_pid = os.getpid()
+            self.__timer = threading.Thread(target=self.__run, name='WriteBuffer', daemon=True)
+            self.__timer.start()
+
+    def __run(self) -> None:
+        while True:
+            wait = self.__last_flush + self.interval - time.monotonic()
+            if wait > 0 or not self.__items:
+                time.sleep(max(wait, self.interval / 10))
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing buffered writes failed")
+            finally:
+                # the database connection of this thread is not closed by the end of a request
+                connections.close_all()
@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded mapping with least-recently-used eviction and time-to-live.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self.__lock:
+            try:
+                expires, value = self.__data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < now:
+                del self.__data[key]
+                self.misses += 1
+                return default
+            self.__data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        with self.__lock:
+            self.__data[key] = (expires, value)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__data.clear()
+
+
+class FailureTracker(object):
+    """
+    A thread-safe, size-bounded count of failures per key in a sliding time window, with least-recently-used eviction.
+
+    The sliding window is estimated from the counts of the current and the previous fixed window, so a key takes the
+    same memory regardless of its number of failures.
+    """
+
+    def __init__(self, maxsize: int, window: float, threshold: int):
+        self.maxsize = maxsize
+        self.window = window
+        self.threshold = threshold
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.threshold > 0 and self.window > 0
+
+    def __count(self, entry, slot: int, progress: float) -> float:
+        entry_slot, current, previous = entry
+        if entry_slot == slot:
+            return current + previous * (1 - progress)
+        if entry_slot == slot - 1:
+            return current * (1 - progress)
+        return 0.0
+
+    def __now(self):
+        now = time.monotonic() / self.window
+        return int(now), now % 1
+
+    def count(self, key: Hashable) -> float:
+        """
+        :return: estimated number of failures of the key in the last window
+        """
+        if not self.enabled:
+            return 0.0
+        slot, progress = self.__now()
+        with self.__lock:
+            entry = self.__data.get(key)
+            if entry is None:
+                return 0.0
+            count = self.__count(entry, slot, progress)
+            if count == 0.0:
+                del self.__data[key]
+            return count
+
+    def is_blocked(self, key: Hashable) -> bool:
+        return self.enabled and self.count(key) >= self.threshold
+
+    def fail(self, key: Hashable) -> None:
+        if not self.enabled:
+            return
+        slot, progress = self.__now()
+        with self.__lock:
+            entry_slot, current, previous = self.__data.get(key, (slot, 0, 0))
+            if entry_slot == slot - 1:
+                current, previous = 0, current
+            elif entry_slot != slot:
+                current, previous = 0, 0
+            self.__data[key] = (slot, current + 1, previous)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def forget(self, match: Callable[[Hashable], bool]) -> None:
+        """
+        Remove the failures of all keys for which match is true.
+        """
+        with self.__lock:
+            for key in [key for key in self.__data if match(key)]:
+                del self.__data[key]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__data.clear()
@@ -1,4 +1,7 @@
-from ipaddress import IPv6Address, AddressValueError
+import re
+from functools import lru_cache
+from ipaddress import IPv4Address, IPv6Address, AddressValueError
+from typing import Iterable, List, Optional, Tuple
 
 
 def normalize_ip(ip: str) -> str:
@@ -8,3 +11,83 @@ def normalize_ip(ip: str) -> str:
         return str(ret)
     except AddressValueError:
         return ip
+
+
+# Effective address computation on plain integers: the network prefix of the host address combined with the host
+# identifier of a record. Netmasks are looked up in precomputed tables, parsing is cached because hosts and host
+# identifiers repeat a lot, and formatting produces the same strings as the ipaddress module.
+
+IPV4_MASKS = tuple(((1 << 32) - 1) ^ ((1 << (32 - n)) - 1) for n in range(33))
+IPV6_MASKS = tuple(((1 << 128) - 1) ^ ((1 << (128 - n)) - 1) for n in range(129))
+
+_IPV6_ZERO_RUN = re.compile(r"(?<![^:])0(?::0)+(?![^:])")
+
+
+@lru_cache(maxsize=65536)
+def parse_ipv4(ip: str) -> int:
+    return int(IPv4Address(ip))
+
+
+@lru_cache(maxsize=65536)
+def parse_ipv6(ip: str) -> int:
+    return int(IPv6Address(ip))
+
+
+def format_ipv4(ip: int) -> str:
+    return "{}.{}.{}.{}".format(ip >> 24, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff)
+
+
+def format_ipv6(ip: int) -> str:
+    digits = "{:032x}".format(ip)
+    text = ":".join([digits[i:i + 4].lstrip("0") or "0" for i in range(0, 32, 4)])
+
+    # compress the longest (first, if tied) run of at least two zero hextets, like ipaddress does
+    best = None
+    for match in _IPV6_ZERO_RUN.finditer(text):
+        if best is None or match.end() - match.start() > best.end() - best.start():
+            best = match
+    if best is None:
+        return text
+    return text[:best.start()].rstrip(":") + "::" + text[best.end():].lstrip(":")
+
+
+def compose_ipv4(host_ip: int, netmask: int, host_id: int) -> int:
+    mask = IPV4_MASKS[netmask]
+    return (host_ip & mask) | (host_id & ~mask & 0xffffffff)
+
+
+def compose_ipv6(host_ip: int, netmask: int, host_id: int) -> int:
+    mask = IPV6_MASKS[netmask]
+    return (host_ip & mask) | (host_id & ~mask & IPV6_MASKS[128])
+
+
+def effective_ipv4(host_ip: Optional[str], netmask: int, host_id: str) -> Optional[str]:
+    if host_ip is None or host_ip == "":
+        return None
+    return format_ipv4(compose_ipv4(parse_ipv4(host_ip), netmask, parse_ipv4(host_id)))
+
+
+def effective_ipv6(host_ip: Optional[str], netmask: int, host_id: str) -> Optional[str]:
+    if host_ip is None or host_ip == "":
+        return None
+    return format_ipv6(compose_ipv6(parse_ipv6(host_ip), netmask, parse_ipv6(host_id)))
+
+
+def effective_ipv4_many(host_ip: Optional[str], compositions: Iterable[Tuple[int, str]]) -> List[Optional[str]]:
+    """
+    Effective IPv4 addresses for many (netmask, host_id) pairs of the same host address.
+    """
+    if host_ip is None or host_ip == "":
+        return [None for _ in compositions]
+    host = parse_ipv4(host_ip)
+    return [format_ipv4(compose_ipv4(host, netmask, parse_ipv4(host_id))) for netmask, host_id in compositions]
+
+
+def effective_ipv6_many(host_ip: Optional[str], compositions: Iterable[Tuple[int, str]]) -> List[Optional[str]]:
+    """
+    Effective IPv6 addresses for many (netmask, host_id) pairs of the same host address.
+    """
+    if host_ip is None or host_ip == "":
+        return [None for _ in compositions]
+    host = parse_ipv6(host_ip)
+    return [format_ipv6(compose_ipv6(host, netmask, parse_ipv6(host_id))) for netmask, host_id in compositions]
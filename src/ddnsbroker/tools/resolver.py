@@ -0,0 +1,159 @@
+"""
+A minimal asynchronous DNS stub resolver for A and AAAA lookups over UDP.
+
+It sends one recursion-desired query per lookup to a single name server and does not cache, so asking the
+authoritative server of a zone shows what is published right now.
+"""
+
+import asyncio
+import random
+import struct
+from ipaddress import IPv4Address, IPv6Address
+from typing import List, Optional, Tuple
+
+A = 1
+AAAA = 28
+CLASS_IN = 1
+
+NOERROR = 0
+NXDOMAIN = 3
+
+
+class ResolverError(Exception):
+    pass
+
+
+def nameserver_from_resolv_conf(path: str = '/etc/resolv.conf') -> str:
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    return fields[1]
+    except OSError:
+        pass
+    return '127.0.0.1'
+
+
+def build_query(query_id: int, name: str, rdtype: int) -> bytes:
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    labels = b''.join(
+        struct.pack('!B', len(label)) + label for label in name.rstrip('.').encode('idna').split(b'.') if label)
+    return header + labels + b'\x00' + struct.pack('!HH', rdtype, CLASS_IN)
+
+
+def _skip_name(message: bytes, offset: int) -> int:
+    while True:
+        length = message[offset]
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(message: bytes, query_id: int, rdtype: int) -> List[str]:
+    """
+    :return: the addresses of the type in the answer section, empty for NXDOMAIN
+    :raise ResolverError: if the response is unusable or the server failed
+    """
+    try:
+        response_id, flags, qdcount, ancount, _, _ = struct.unpack_from('!HHHHHH', message)
+        if response_id != query_id or not flags & 0x8000:
+            raise ResolverError("unexpected response")
+        if flags & 0x0200:
+            raise ResolverError("truncated response")
+        rcode = flags & 0x000f
+        if rcode == NXDOMAIN:
+            return []
+        if rcode != NOERROR:
+            raise ResolverError("rcode {}".format(rcode))
+
+        offset = 12
+        for _ in range(qdcount):
+            offset = _skip_name(message, offset) + 4
+
+        addresses = []
+        for _ in range(ancount):
+            offset = _skip_name(message, offset)
+            rrtype, rrclass, _, rdlength = struct.unpack_from('!HHIH', message, offset)
+            offset += 10
+            rdata = message[offset:offset + rdlength]
+            offset += rdlength
+            if rrtype != rdtype or rrclass != CLASS_IN:
+                continue
+            if rrtype == A and len(rdata) == 4:
+                addresses.append(str(IPv4Address(rdata)))
+            elif rrtype == AAAA and len(rdata) == 16:
+                addresses.append(str(IPv6Address(rdata)))
+        return addresses
+    except (struct.error, IndexError) as e:
+        raise ResolverError("malformed response") from e
+
+
+class _QueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query: bytes):
+        self.query = query
+        self.response = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        transport.sendto(self.query)
+
+    def datagram_received(self, data, addr):
+        if not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
+
+class Resolver(object):
+    def __init__(self, nameserver: Optional[str] = None, port: int = 53, timeout: float = 2.0, tries: int = 2):
+        self.nameserver = nameserver or nameserver_from_resolv_conf()
+        self.port = port
+        self.timeout = timeout
+        self.tries = tries
+
+    async def __query(self, name: str, rdtype: int) -> List[str]:
+        query_id = random.getrandbits(16)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: _QueryProtocol(build_query(query_id, name, rdtype)),
+            remote_addr=(self.nameserver, self.port))
+        try:
+            message = await asyncio.wait_for(protocol.response, self.timeout)
+        finally:
+            transport.close()
+        return parse_response(message, query_id, rdtype)
+
+    async def resolve(self, name: str, rdtype: int) -> List[str]:
+        """
+        :raise ResolverError: if there is no usable answer after all tries
+        """
+        error = None
+        for _ in range(self.tries):
+            try:
+                return await self.__query(name, rdtype)
+            except asyncio.TimeoutError:
+                error = "timeout"
+            except (OSError, ResolverError) as e:
+                error = str(e)
+        raise ResolverError("{} {}: {}".format(name, 'AAAA' if rdtype == AAAA else 'A', error))
+
+    async def resolve_many(self, queries: List[Tuple[str, int]], concurrency: int = 50) -> List[object]:
+        """
+        Resolve (name, rdtype) pairs with at most `concurrency` queries in flight.
+        :return: a list of addresses or a ResolverError for every query, in order
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(name, rdtype):
+            async with semaphore:
+                try:
+                    return await self.resolve(name, rdtype)
+                except ResolverError as e:
+                    return e
+
+        return await asyncio.gather(*(resolve(name, rdtype) for name, rdtype in queries))
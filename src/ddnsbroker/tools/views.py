@@ -30,9 +30,12 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import asyncio
 import base64
+from functools import update_wrapper
 
 from django.http import HttpResponse
+from django.utils.decorators import classonlymethod
 
 
 class PlainResponse(HttpResponse):
@@ -41,6 +44,25 @@ class PlainResponse(HttpResponse):
         super().__init__(*args, **kwargs)
 
 
+class AsyncViewMixin(object):
+    """
+    Makes a class-based view with async handlers a coroutine function, so it is run natively under ASGI.
+    """
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        async def async_view(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        update_wrapper(async_view, view)
+        return async_view
+
+
 def basic_challenge(realm, content='Authorization Required'):
     """
     Construct a 401 response requesting http basic auth.
@@ -0,0 +1,342 @@
+"""
+Streaming import and export of update services, hosts and records, used by the importdata and exportdata commands.
+
+A row is a JSON object per line, with the model in its "model" key, or a CSV row of a single model, with the FIELDS
+of its model. Rows refer to other objects by their natural keys: update services by name, hosts by FQDN and records by
+host and FQDN. An imported row creates its object or updates the existing one, fields missing in a row keep their
+current or default values. Host secrets are exported hashed (secret_hash), imported secrets are either hashed already
+(secret_hash) or plaintext (secret), which are hashed in a process pool.
+
+The import reads the rows one after another and works in chunks of rows of the same model: every chunk is validated
+and written with bulk_create and bulk_update in one transaction, so the memory does not grow with the file. Imported
+records are not pushed one by one, resync() queues the pushes of all records that need one once the import is done.
+"""
+
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import django
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from ddnsbroker import auth, history, hostcache
+from ddnsbroker.models import Host, Record, UpdateEvent, UpdateService, UpdateTask
+
+MODELS = ('service', 'host', 'record')
+
+FIELDS = {
+    'service': ('name', 'url', 'username_is_fqdn', 'concurrency', 'pool_size', 'timeout', 'max_hostnames',
+                'rate_limit'),
+    'host': ('fqdn', 'secret_hash', 'ipv4_enabled', 'ipv6_enabled', 'ipv4', 'ipv6', 'debounce'),
+    'record': ('host', 'fqdn', 'service', 'ipv4_enabled', 'ipv6_enabled', 'ipv4_netmask', 'ipv4_host_id',
+               'ipv6_netmask', 'ipv6_host_id', 'username', 'password'),
+}
+
+# fields of imported rows, plaintext secrets are imported but never exported
+IMPORT_FIELDS = {'service': FIELDS['service'], 'host': FIELDS['host'] + ('secret',), 'record': FIELDS['record']}
+
+# model fields of the exported values, the others are the same
+_SOURCES = {'secret_hash': 'secret', 'host': 'host__fqdn', 'service': 'service__name'}
+
+# model fields written when an existing object is updated
+_UPDATE_FIELDS = {
+    'service': FIELDS['service'][1:],
+    'host': ('secret', 'ipv4_enabled', 'ipv6_enabled', 'ipv4', 'ipv6', 'debounce', 'last_ipv4_change',
+             'last_ipv6_change'),
+    'record': FIELDS['record'][3:] + ('service_id', 'update_error', 'effective_ipv4', 'effective_ipv6',
+                                      'last_ipv4_change', 'last_ipv6_change'),
+}
+
+Row = Tuple[int, str, Dict]
+
+
+def export_rows(model: str) -> Iterator[Dict]:
+    """
+    All objects of the model as rows, read from the database in chunks.
+    """
+    queryset = {'service': UpdateService, 'host': Host, 'record': Record}[model].objects.order_by('pk')
+    values = queryset.values_list(*(_SOURCES.get(field, field) for field in FIELDS[model]))
+    for values in values.iterator(chunk_size=2000):
+        yield dict(zip(FIELDS[model], values))
+
+
+def write_jsonl(stream, model: str, rows: Iterable[Dict]) -> int:
+    """
+    :return: number of written rows
+    """
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict(model=model, **row)) + "\n")
+        count += 1
+    return count
+
+
+def write_csv(stream, model: str, rows: Iterable[Dict]) -> int:
+    """
+    :return: number of written rows
+    """
+    writer = csv.DictWriter(stream, FIELDS[model])
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def read_jsonl(stream) -> Iterator[Row]:
+    """
+    :return: (line number, model, row) of every line, the row is None if the line is not a JSON object
+    """
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            yield line_number, '', None
+            continue
+        yield line_number, row.pop('model', ''), row
+
+
+def read_csv(stream, model: str) -> Iterator[Row]:
+    """
+    :return: (line number, model, row) of every row, empty values are missing in the row
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, model, {key: value for key, value in row.items() if key and value != ''}
+
+
+def _chunks(rows: Iterable[Row], chunk_size: int) -> Iterator[List[Row]]:
+    """
+    Group consecutive rows of the same model.
+    """
+    chunk = []
+    for row in rows:
+        if chunk and (len(chunk) >= chunk_size or chunk[-1][1] != row[1]):
+            yield chunk
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+
+class Importer(object):
+    def __init__(self, chunk_size: int = 1000, workers: Optional[int] = None,
+                 error: Optional[Callable[[int, str], None]] = None):
+        """
+        :param workers: number of processes hashing secrets, 0 hashes them in this process (default: CPU count)
+        :param error: called with the line number and the error of every row that is not imported
+        """
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.error = error
+        self.stats = {'created': 0, 'updated': 0, 'unchanged': 0, 'errors': 0}
+        self.__pool = None
+        self.__services = None
+
+    def close(self) -> None:
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+    def __fail(self, line_number: int, message: str) -> None:
+        self.stats['errors'] += 1
+        if self.error is not None:
+            self.error(line_number, message)
+
+    def __hash(self, secrets: List[str]) -> List[str]:
+        if not secrets:
+            return []
+        if self.workers == 0:
+            return [auth.make_secret(secret) for secret in secrets]
+        if self.__pool is None:
+            # the workers set up Django themselves if they are not forked
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers, initializer=django.setup)
+        return list(self.__pool.map(auth.make_secret, secrets, chunksize=64))
+
+    def run(self, rows: Iterable[Row]) -> Dict[str, int]:
+        """
+        Import the rows, see read_jsonl and read_csv.
+        :return: number of created, updated, unchanged and failed objects
+        """
+        imports = {'service': self.__import_service, 'host': self.__import_host, 'record': self.__import_record}
+        for chunk in _chunks(rows, self.chunk_size):
+            model = chunk[0][1]
+            valid = []
+            for line_number, _, row in chunk:
+                if row is None:
+                    self.__fail(line_number, "not a JSON object")
+                elif model not in MODELS:
+                    self.__fail(line_number, "unknown model {!r}".format(model))
+                elif set(row) - set(IMPORT_FIELDS[model]):
+                    unknown = sorted(set(row) - set(IMPORT_FIELDS[model]))
+                    self.__fail(line_number, "unknown fields {}".format(", ".join(unknown)))
+                else:
+                    valid.append((line_number, row))
+            if valid:
+                with transaction.atomic():
+                    imports[model](valid)
+        return self.stats
+
+    def __validate(self, line_number: int, obj, exclude: Tuple[str, ...] = ()) -> bool:
+        try:
+            obj.clean_fields(exclude=exclude)
+        except ValidationError as e:
+            self.__fail(line_number, "; ".join(
+                "{}: {}".format(field, " ".join(messages)) for field, messages in e.message_dict.items()))
+            return False
+        return True
+
+    def __upsert(self, model, objects: List, snapshot: Dict[int, Dict], fields: Tuple[str, ...]) -> None:
+        """
+        Create the new objects and update the changed fields of the existing ones.
+        :param snapshot: the fields of the existing objects before the rows were applied to them, see __snapshot
+        """
+        created = [obj for obj in objects if obj.pk is None]
+        model.objects.bulk_create(created, batch_size=500)
+        self.stats['created'] += len(created)
+
+        updated, changed = [], set()
+        for obj in objects:
+            if obj.pk is None:
+                continue
+            fields_changed = {field for field in fields if getattr(obj, field) != snapshot[obj.pk][field]}
+            if fields_changed:
+                updated.append(obj)
+                changed |= fields_changed
+            else:
+                self.stats['unchanged'] += 1
+        if updated:
+            # bulk_update sets every field with a CASE over the whole batch, small batches of few fields are faster
+            model.objects.bulk_update(updated, sorted(changed), batch_size=100)
+        self.stats['updated'] += len(updated)
+
+    @staticmethod
+    def __snapshot(objects: Iterable, model: str) -> Dict[int, Dict]:
+        return {obj.pk: {field: getattr(obj, field) for field in _UPDATE_FIELDS[model]} for obj in objects}
+
+    def __import_service(self, rows: List[Tuple[int, Dict]]) -> None:
+        existing = UpdateService.objects.in_bulk([row.get('name') for line_number, row in rows], field_name='name')
+        snapshot = self.__snapshot(existing.values(), 'service')
+        services = {}
+        for line_number, row in rows:
+            service = services.get(row.get('name')) or existing.get(row.get('name')) or UpdateService()
+            for field, value in row.items():
+                setattr(service, field, value)
+            if self.__validate(line_number, service):
+                services[service.name] = service
+            else:
+                # an earlier row of the service is not imported either, the object has invalid values now
+                services.pop(row.get('name'), None)
+        self.__upsert(UpdateService, list(services.values()), snapshot, _UPDATE_FIELDS['service'])
+        hostcache.service_cache.clear()
+        self.__services = None
+
+    def __import_host(self, rows: List[Tuple[int, Dict]]) -> None:
+        now = timezone.now()
+        existing = Host.objects.in_bulk([row.get('fqdn') for line_number, row in rows], field_name='fqdn')
+        snapshot = self.__snapshot(existing.values(), 'host')
+
+        hosts, plaintext = {}, []
+        for line_number, row in rows:
+            host = hosts.get(row.get('fqdn')) or existing.get(row.get('fqdn')) or Host()
+            for field, value in row.items():
+                setattr(host, _SOURCES.get(field, field), value)
+            if host.pk is None and 'secret' not in row and 'secret_hash' not in row:
+                self.__fail(line_number, "secret: a new host needs a secret or secret_hash")
+            elif self.__validate(line_number, host):
+                hosts[host.fqdn] = host
+                if 'secret' in row:
+                    plaintext.append(host)
+            else:
+                hosts.pop(row.get('fqdn'), None)
+        plaintext = [host for host in plaintext if hosts.get(host.fqdn) is host]
+        for host, secret in zip(plaintext, self.__hash([host.secret for host in plaintext])):
+            host.secret = secret
+
+        changed = []
+        for host in hosts.values():
+            before = snapshot.get(host.pk, {})
+            if host.pk is not None and host.secret != before['secret']:
+                auth.invalidate(host.fqdn)
+            changes = [(family, getattr(host, field)) for family, field in ((UpdateTask.IPV4, 'ipv4'),
+                                                                            (UpdateTask.IPV6, 'ipv6'))
+                       if getattr(host, field) and getattr(host, field) != before.get(field)]
+            for family, ip in changes:
+                setattr(host, 'last_ipv4_change' if family == UpdateTask.IPV4 else 'last_ipv6_change', now)
+                if host.pk is not None:
+                    history.record(UpdateEvent.ip_change(host, family, ip, now))
+            if changes and host.pk is not None:
+                changed.append(host)
+
+        self.__upsert(Host, list(hosts.values()), snapshot, _UPDATE_FIELDS['host'])
+        hostcache.delete(*hosts)
+        # records that are not imported follow the new addresses of their hosts too
+        Record.propagate(changed, now=now, queue=False)
+
+    def __import_record(self, rows: List[Tuple[int, Dict]]) -> None:
+        now = timezone.now()
+        if self.__services is None:
+            self.__services = UpdateService.objects.in_bulk(field_name='name')
+        hosts = Host.objects.in_bulk({row.get('host') for line_number, row in rows}, field_name='fqdn')
+        existing = {
+            (record.host_id, record.fqdn): record
+            for record in Record.objects.filter(
+                host__in=hosts.values(), fqdn__in=[row.get('fqdn') or row.get('host') for line_number, row in rows]
+            ).select_related('service')
+        }
+        snapshot = self.__snapshot(existing.values(), 'record')
+
+        records = {}
+        for line_number, row in rows:
+            host = hosts.get(row.get('host'))
+            if host is None:
+                self.__fail(line_number, "host: no host {!r}".format(row.get('host')))
+                continue
+            key = (host.pk, row.get('fqdn') or host.fqdn)
+            record = records.get(key) or existing.get(key) or Record(host=host)
+            for field, value in row.items():
+                if field == 'service':
+                    record.service = self.__services.get(value)
+                elif field != 'host':
+                    setattr(record, field, value)
+            if record.service_id is not None and self.__validate(line_number, record, exclude=('host', 'service')):
+                record.host = host
+                # importing a record acknowledges its update error, like saving it
+                record.update_error = ""
+                record.refresh(now=now)
+                records[key] = record
+            else:
+                if record.service_id is None:
+                    self.__fail(line_number, "service: no update service {!r}".format(row.get('service', "")))
+                records.pop(key, None)
+
+        self.__upsert(Record, list(records.values()), snapshot, _UPDATE_FIELDS['record'])
+        hostcache.delete(*hosts)
+
+
+def resync(chunk_size: int = 1000) -> int:
+    """
+    Queue the pushes of all records that need one, chunk by chunk. Queued pushes get the current addresses.
+    :return: number of pending pushes
+    """
+    queued = 0
+    for family in (UpdateTask.IPV4, UpdateTask.IPV6):
+        last_pk = 0
+        while True:
+            records = list(Record.needing_push(family).filter(update_error="", pk__gt=last_pk)
+                           .select_related('host')[:chunk_size])
+            if not records:
+                break
+            last_pk = records[-1].pk
+            pending = [update for record in records for update in record.pending_updates() if update[1] == family]
+            UpdateTask.enqueue_many(pending)
+            queued += len(pending)
+    return queued
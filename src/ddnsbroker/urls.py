@@ -1,14 +1,24 @@
 """
 ddnsbroker URL Configuration
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 
 from ddnsbroker.views import *
 
+if getattr(settings, 'DDNSBROKER_ASYNC_VIEWS', False):
+    remote_ip_view = AsyncRemoteIpView.as_view()
+    nic_update_view = AsyncNicUpdateView.as_view()
+else:
+    remote_ip_view = RemoteIpView.as_view()
+    nic_update_view = NicUpdateView.as_view()
+
 urlpatterns = [
-    path('', RemoteIpView.as_view()),
-    path('myip', RemoteIpView.as_view()),
-    path('nic/update', NicUpdateView.as_view()),
+    path('', remote_ip_view),
+    path('myip', remote_ip_view),
+    path('nic/update', nic_update_view),
+    path('nic/batch', NicBatchUpdateView.as_view()),
+    path('metrics', MetricsView.as_view()),
     path('admin/', admin.site.urls),
 ]
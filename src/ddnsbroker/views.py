@@ -1,82 +1,300 @@
+import asyncio
+import json
 import logging
 import re
-from ipaddress import IPv4Address, IPv6Address, AddressValueError
+import time
+from ipaddress import IPv4Address, IPv6Address, AddressValueError, ip_address, ip_network
+from typing import List, Optional, Tuple
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from ddnsbroker import auth, lastseen, metrics
 from ddnsbroker.models import Host
 from ddnsbroker.tools.ip import normalize_ip
-from ddnsbroker.tools.views import PlainResponse, basic_challenge, basic_authenticate
+from ddnsbroker.tools.views import AsyncViewMixin, PlainResponse, basic_challenge, basic_authenticate
 
 logger = logging.getLogger(__name__)
 
+FQDN_PATTERN = re.compile(r"(?=^.{4,253}$)(^((?!-)[a-zA-Z0-9-]{1,63}(?<!-)\.)+[a-zA-Z]{2,63}$)")
+
+
+def _same_ip(address_class, stored, reported) -> bool:
+    if stored is None or stored == "":
+        return False
+    return address_class(stored) == reported
+
+
+def check_hostname(hostname: Optional[str], username: str) -> Optional[str]:
+    """
+    Check that the hostname to update is the authenticated host.
+    :return: dyndns2 error code or None
+    """
+    if hostname is not None and hostname != username:
+        if not FQDN_PATTERN.match(hostname):
+            error = 'notfqdn'
+        else:
+            error = 'nohost'
+        logger.warning("rejecting to update {}: {} (user: {})".format(hostname, error, username))
+        return error
+    return None
+
+
+def parse_ips(ipaddrs: List[str]) -> Tuple[Optional[IPv4Address], Optional[IPv6Address]]:
+    """
+    Get the last valid IPv4 and IPv6 address.
+    :raise Exception: if there is no valid address
+    """
+    ipv4, ipv6 = None, None
+    for ipaddr in ipaddrs:
+        try:
+            ipv4 = IPv4Address(ipaddr)
+        except AddressValueError:
+            try:
+                ipv6 = IPv6Address(ipaddr)
+            except AddressValueError:
+                pass
+
+    if not ipv4 and not ipv6:
+        logger.warning("no valid ipv4/ipv6 found in: {}".format(ipaddrs))
+        raise Exception()
+
+    return ipv4, ipv6
+
+
+def stage_update(host: Host, ipv4: Optional[IPv4Address], ipv6: Optional[IPv6Address], now) -> List[str]:
+    """
+    Set the reported addresses of the enabled ip families on the host.
+    If nothing changed, the last_update timestamps are written (batched) right away.
+    :return: the fields to save (of Host.UPDATE_FIELDS), empty if the host has not to be saved
+    """
+    update_ipv4 = bool(ipv4) and host.ipv4_enabled
+    update_ipv6 = bool(ipv6) and host.ipv6_enabled
+
+    if (not update_ipv4 or _same_ip(IPv4Address, host.ipv4, ipv4)) and \
+            (not update_ipv6 or _same_ip(IPv6Address, host.ipv6, ipv6)):
+        lastseen.touch(host, now, ipv4=update_ipv4, ipv6=update_ipv6)
+        return []
+
+    # update host ip and last_update if ip family is enabled
+    update_fields = []
+    if update_ipv4:
+        host.last_ipv4_update = now
+        host.ipv4 = str(ipv4)
+        update_fields += ['ipv4', 'last_ipv4_update', 'last_ipv4_change']
+    if update_ipv6:
+        host.last_ipv6_update = now
+        host.ipv6 = str(ipv6)
+        update_fields += ['ipv6', 'last_ipv6_update', 'last_ipv6_change']
+    return update_fields
+
+
+def format_response(response: str, ipv4: Optional[IPv4Address], ipv6: Optional[IPv6Address]) -> str:
+    if ipv4 and ipv6:
+        ipstr = "{},{}".format(ipv4, ipv6)
+    elif ipv4:
+        ipstr = str(ipv4)
+    else:
+        ipstr = str(ipv6)
+    return "{} {}".format(response, ipstr)
+
+
+def remote_ip(request) -> str:
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if x_forwarded_for:
+        ip = x_forwarded_for.split(',')[0]
+    else:
+        ip = request.META.get('REMOTE_ADDR')
+    return normalize_ip(ip)
+
+
+def _in_networks(address: str, networks: List[str]) -> bool:
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ip_network(network, strict=False) for network in networks)
+
+
+def is_trusted_proxy(address: str) -> bool:
+    """
+    Whether the address is in DDNSBROKER_TRUSTED_PROXIES, a list of addresses and networks (default: empty).
+    """
+    return _in_networks(address, getattr(settings, 'DDNSBROKER_TRUSTED_PROXIES', []))
+
+
+def client_address(request) -> str:
+    """
+    The address failed authentications are counted for: the peer address, or, if the peer is a trusted proxy, the
+    last X-Forwarded-For entry, which that proxy appended. Unlike remote_ip, it cannot be chosen by the client.
+    """
+    address = normalize_ip(request.META.get('REMOTE_ADDR'))
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    if x_forwarded_for and is_trusted_proxy(address):
+        address = normalize_ip(x_forwarded_for.split(',')[-1].strip())
+    return address
+
 
 class RemoteIpView(View):
     def get(self, request):
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return PlainResponse(normalize_ip(ip))
+        return PlainResponse(remote_ip(request))
+
+
+class AsyncRemoteIpView(AsyncViewMixin, RemoteIpView):
+    async def get(self, request):
+        return super().get(request)
+
+
+def _observe(start: float, response: HttpResponse) -> HttpResponse:
+    metrics.NIC_UPDATE_SECONDS.observe(time.perf_counter() - start)
+    metrics.NIC_UPDATE_RESPONSES.inc(response.content.split(b" ", 1)[0].decode('ascii', errors='replace'))
+    return response
+
+
+async def _observe_async(start: float, response) -> HttpResponse:
+    return _observe(start, await response)
+
+
+class MetricsView(View):
+    """
+    Serves the metrics to the addresses in DDNSBROKER_METRICS_ALLOWED (default: localhost) and to requests with the
+    bearer token DDNSBROKER_METRICS_TOKEN (default: None, no token).
+    """
+
+    def is_allowed(self, request) -> bool:
+        token = getattr(settings, 'DDNSBROKER_METRICS_TOKEN', None)
+        if token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), "Bearer " + token):
+            return True
+        return _in_networks(client_address(request),
+                            getattr(settings, 'DDNSBROKER_METRICS_ALLOWED', ['127.0.0.1', '::1']))
+
+    def get(self, request):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
 
 
 class NicUpdateView(View):
-    def auth_against_host(self, request):
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            return _observe_async(start, response)
+        return _observe(start, response)
+
+    def get_credentials(self, request):
         auth = request.META.get('HTTP_AUTHORIZATION')
         if auth is None:
             logger.debug("received no auth")
             raise Exception()
-        username, password = basic_authenticate(auth)
+        return basic_authenticate(auth)
+
+    def auth_against_host(self, request):
+        username, password = self.get_credentials(request)
+        address = client_address(request)
+
+        if auth.is_blocked(username, password, address):
+            logger.debug("rejected known bad credentials for {} from {}".format(username, address))
+            raise Exception()
 
         try:
-            host = Host.objects.get(fqdn=username)
+            host = Host.get_cached(username)
             if host.check_password(password):
                 return host
         except Host.DoesNotExist:
             pass
 
         logger.warning("received bad credentials for {}".format(username))
+        auth.record_failure(username, password, address)
         raise Exception()
 
     def check_hostname(self, request, username):
-        hostname = request.GET.get('hostname')
-        if hostname is not None and hostname != username:
-            fqdn_patter = re.compile(r"(?=^.{4,253}$)(^((?!-)[a-zA-Z0-9-]{1,63}(?<!-)\.)+[a-zA-Z]{2,63}$)")
-            if not fqdn_patter.match(hostname):
-                error = 'notfqdn'
-            else:
-                error = 'nohost'
-            logger.warning("rejecting to update {}: {} (user: {})".format(hostname, error, username))
-            return error
-        return None
+        return check_hostname(request.GET.get('hostname'), username)
 
     def get_ips_from_request(self, request):
         ipaddrs = request.GET.getlist('myip')
         if not ipaddrs:
             ipaddrs = [normalize_ip(request.META.get('REMOTE_ADDR'))]
+        return parse_ips(ipaddrs)
 
-        ipv4, ipv6 = None, None
-        for ipaddr in ipaddrs:
-            try:
-                ipv4 = IPv4Address(ipaddr)
-            except AddressValueError:
-                try:
-                    ipv6 = IPv6Address(ipaddr)
-                except AddressValueError:
-                    pass
+    def get(self, request):
+        # authenticate
+        try:
+            with metrics.PHASE_SECONDS.time('auth'):
+                host = self.auth_against_host(request)
+        except Exception:
+            return basic_challenge("Authenticate to update DNS", 'badauth')
 
-        if not ipv4 and not ipv6:
-            logger.warning("no valid ipv4/ipv6 found in: {}".format(ipaddrs))
+        # check if hostname matches username
+        error = self.check_hostname(request, host.fqdn)
+        if error:
+            return PlainResponse(error)
+
+        # get ips from request
+        try:
+            ipv4, ipv6 = self.get_ips_from_request(request)
+        except Exception:
+            return PlainResponse("nochg")
+
+        now = timezone.now()
+        update_fields = stage_update(host, ipv4, ipv6, now)
+        if update_fields:
+            # only the reported addresses, the other fields of a cached host may be outdated
+            ip_changed = host.save(now=now, update_fields=update_fields)
+        else:
+            ip_changed = False
+
+        # construct response
+        response = "good" if ip_changed else "nochg"
+
+        logger.info("{} {}".format(host.fqdn, format_response(response, ipv4, ipv6)))
+
+        return PlainResponse(format_response(response, ipv4, ipv6))
+
+
+class AsyncNicUpdateView(AsyncViewMixin, NicUpdateView):
+    """
+    NicUpdateView for ASGI deployments.
+
+    Requests are handled on the event loop, only the database access runs in Django's (single) ORM thread and the
+    password hashing in a thread pool, so slow clients do not occupy a worker thread.
+    """
+
+    async def auth_against_host(self, request):
+        username, password = self.get_credentials(request)
+        address = client_address(request)
+
+        if auth.is_blocked(username, password, address):
+            logger.debug("rejected known bad credentials for {} from {}".format(username, address))
             raise Exception()
 
-        return ipv4, ipv6
+        try:
+            host = await sync_to_async(Host.get_cached)(username)
+            upgraded = []
+            if await sync_to_async(host.check_password, thread_sensitive=False)(password, setter=upgraded.append):
+                if upgraded:
+                    # in the ORM thread, the threads of the pool do not close their database connections
+                    await sync_to_async(host.upgrade_secret)(upgraded[0])
+                return host
+        except Host.DoesNotExist:
+            pass
 
-    def get(self, request):
+        logger.warning("received bad credentials for {}".format(username))
+        auth.record_failure(username, password, address)
+        raise Exception()
+
+    async def get(self, request):
         # authenticate
         try:
-            host = self.auth_against_host(request)
+            with metrics.PHASE_SECONDS.time('auth'):
+                host = await self.auth_against_host(request)
         except Exception:
             return basic_challenge("Authenticate to update DNS", 'badauth')
 
@@ -91,27 +309,126 @@ class NicUpdateView(View):
         except Exception:
             return PlainResponse("nochg")
 
-        # update host ip and last_update if ip family is enabled
         now = timezone.now()
-        if ipv4 and host.ipv4_enabled:
-            host.last_ipv4_update = now
-            host.ipv4 = str(ipv4)
-        if ipv6 and host.ipv6_enabled:
-            host.last_ipv6_update = now
-            host.ipv6 = str(ipv6)
-
-        ip_changed = host.save(now=now)
+        update_fields = await sync_to_async(stage_update)(host, ipv4, ipv6, now)
+        if update_fields:
+            ip_changed = await sync_to_async(host.save)(now=now, update_fields=update_fields)
+        else:
+            ip_changed = False
 
         # construct response
         response = "good" if ip_changed else "nochg"
 
-        if ipv4 and ipv6:
-            ipstr = "{},{}".format(ipv4, ipv6)
-        elif ipv4:
-            ipstr = str(ipv4)
-        else:
-            ipstr = str(ipv6)
+        logger.info("{} {}".format(host.fqdn, format_response(response, ipv4, ipv6)))
+
+        return PlainResponse(format_response(response, ipv4, ipv6))
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class NicBatchUpdateView(View):
+    """
+    Update many hosts with one request.
+
+    The body is either a JSON list of objects with the keys "hostname", "secret" and "myip" (a string or a list of
+    strings), or plain text with one "hostname secret myip [myip]" line per host. Every host is authenticated with its
+    own secret, a request with bad credentials counts as one failure of the client address however many hosts
+    failed. The response has one "hostname code [ips]" line per host in request order, the codes are the same as
+    for /nic/update. The hosts are applied in chunks of DDNSBROKER_BATCH_CHUNK_SIZE (default: 500), one transaction
+    per chunk, and the response is sent after the last chunk is committed.
+    """
+
+    def parse_body(self, request) -> List[Tuple[str, str, List[str]]]:
+        """
+        :raise ValueError: if the body is malformed
+        """
+        body = request.body.decode('utf-8')
+
+        if request.content_type == 'application/json':
+            updates = []
+            for entry in json.loads(body):
+                myip = entry.get('myip', [])
+                if isinstance(myip, str):
+                    myip = [myip]
+                updates.append((str(entry.get('hostname', '')), str(entry.get('secret', '')), [str(ip) for ip in myip]))
+            return updates
+
+        updates = []
+        for line in body.splitlines():
+            fields = line.split()
+            if fields:
+                updates.append((fields[0], fields[1] if len(fields) > 1 else '', fields[2:]))
+        return updates
+
+    def apply(self, updates: List[Tuple[str, str, List[str]]]) -> List[str]:
+        hosts = Host.objects.in_bulk({hostname for hostname, secret, ipaddrs in updates}, field_name='fqdn')
+
+        # (hostname, code) or, for authenticated hosts, (host, ipv4, ipv6) until the staged hosts are saved
+        results = []
+        staged = {}
+        for hostname, secret, ipaddrs in updates:
+            if not FQDN_PATTERN.match(hostname):
+                results.append((hostname, 'notfqdn'))
+                continue
+
+            if self.blocked or auth.is_blocked(hostname, secret):
+                results.append((hostname, 'badauth'))
+                continue
+
+            host = hosts.get(hostname)
+            if host is None or not host.check_password(secret):
+                logger.warning("received bad credentials for {}".format(hostname))
+                # counted against the client address once per request, see post
+                auth.record_failure(hostname, secret)
+                self.failed = True
+                results.append((hostname, 'badauth'))
+                continue
+
+            try:
+                ipv4, ipv6 = parse_ips(ipaddrs)
+            except Exception:
+                results.append((hostname, 'nochg'))
+                continue
+
+            if stage_update(host, ipv4, ipv6, self.now):
+                staged[host.pk] = host
+            results.append((host, ipv4, ipv6))
+
+        hosts = list(staged.values())
+        ip_changed = dict(zip(staged.keys(), Host.save_many(hosts, now=self.now))) if hosts else {}
+
+        lines = []
+        for result in results:
+            if len(result) == 3:
+                host, ipv4, ipv6 = result
+                code = "good" if ip_changed.get(host.pk) else "nochg"
+                line = "{} {}".format(host.fqdn, format_response(code, ipv4, ipv6))
+                logger.info(line)
+            else:
+                hostname, code = result
+                line = "{} {}".format(hostname, code)
+            metrics.NIC_UPDATE_RESPONSES.inc(code)
+            lines.append(line)
+        return lines
+
+    def post(self, request):
+        try:
+            updates = self.parse_body(request)
+        except (ValueError, TypeError, AttributeError):
+            return HttpResponseBadRequest("malformed body", content_type='text/plain')
 
-        logger.info("{} {} {}".format(host.fqdn, response, ipstr))
+        self.now = timezone.now()
+        self.address = client_address(request)
+        # checked once, the stale entries of an aggregator must not lock out its other hosts
+        self.blocked = auth.is_address_blocked(self.address)
+        self.failed = False
 
-        return PlainResponse("{} {}".format(response, ipstr))
+        # all chunks are applied before responding: a streaming response would be iterated on the event loop under
+        # ASGI, where the database cannot be used
+        chunk_size = getattr(settings, 'DDNSBROKER_BATCH_CHUNK_SIZE', 500)
+        lines = []
+        for start in range(0, len(updates), chunk_size):
+            with transaction.atomic():
+                lines += self.apply(updates[start:start + chunk_size])
+        if self.failed:
+            auth.record_address_failure(self.address)
+        return PlainResponse("".join(line + "\n" for line in lines))